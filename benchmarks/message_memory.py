@@ -0,0 +1,90 @@
+"""
+Measure the memory held per V2 message with tracemalloc
+
+Usage: python benchmarks/message_memory.py [--messages N]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from revChatGPT.V2 import Conversation  # noqa: E402
+from revChatGPT.V2 import ConversationStore  # noqa: E402
+from revChatGPT.V2 import Message  # noqa: E402
+
+
+class DictMessage:
+    """
+    Message as it was stored before __slots__ and interning, as the baseline
+    """
+
+    def __init__(self, text: str, author: str, tokens: int = None) -> None:
+        self.text = text
+        self.author = author
+        self.tokens = tokens
+
+
+def build(texts: list[str], message: type) -> Conversation:
+    conversation = Conversation()
+    for i, text in enumerate(texts):
+        # Token counts are given so the tokenizer is not part of the measurement
+        conversation.append(message(text, "User" if i % 2 else "ChatGPT", 10))
+    return conversation
+
+
+def fresh(texts: list[str], message: type) -> float:
+    """
+    Bytes per message built from texts that are already in memory, so the
+    text itself is not counted
+    """
+    tracemalloc.start()
+    conversation = build(texts, message)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del conversation
+    return current / len(texts)
+
+
+def reloaded(texts: list[str], message: type) -> float:
+    """
+    Bytes per message decoded from a ConversationStore row, text included
+    """
+    data = ConversationStore._encode(build(texts, Message))
+    tracemalloc.start()
+    # Same decoding as ConversationStore._decode, with the given message type
+    conversation = Conversation()
+    for author, text, tokens in json.loads(data):
+        conversation.append(message(text, author, tokens))
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del conversation
+    return current / len(texts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--messages",
+        help="Number of messages to create",
+        type=int,
+        default=200000,
+    )
+    args = parser.parse_args()
+    texts = [f"message number {i} " * 3 for i in range(args.messages)]
+    print(f"{'bytes/message':<34}{'__dict__':>10}{'slotted':>10}")
+    for label, measure in (
+        ("Fresh, excluding text", fresh),
+        ("Reloaded, including text", reloaded),
+    ):
+        before = measure(texts, DictMessage)
+        after = measure(texts, Message)
+        print(f"{label:<34}{before:>10.1f}{after:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,8 @@ setup(
     install_requires=[
         "OpenAIAuth==0.3.2",
         "requests",
+        # AsyncClient takes proxy= from 0.26 on; 0.28 removed proxies=
+        "httpx>=0.26",
     ],
     extras_require={
         "unofficial": [
@@ -24,6 +26,15 @@ setup(
             "tls_client",
             "requests",
         ],
+        "zstd": [
+            "zstandard",
+        ],
+    },
+    entry_points={
+        "console_scripts": [
+            "revChatGPT-broker = revChatGPT.broker:main",
+            "revChatGPT-loadtest = revChatGPT.loadtest:main",
+        ],
     },
     long_description=open("README.md", encoding="utf-8").read(),
     long_description_content_type="text/markdown",
@@ -1,27 +1,297 @@
+import asyncio
+import base64
 import json
 import logging
+import os
 import re
+import socket
+import threading
 import uuid
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextlib import contextmanager
+from functools import partial
+from time import time
+from weakref import WeakValueDictionary
 
-import tls_client
 import undetected_chromedriver as uc
 from requests.exceptions import HTTPError
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 
-# Disable all logging
-logging.basicConfig(level=logging.ERROR)
+if __package__:
+    from .tracing import Tracer
+    from .transport import check_response
+    from .transport import RequestsTransport
+    from .transport import TLSClientTransport
+else:
+    # Run as a script, e.g. python src/revChatGPT/Unofficial.py
+    from tracing import Tracer
+    from transport import check_response
+    from transport import RequestsTransport
+    from transport import TLSClientTransport
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where the cache is used without locking
+    fcntl = None
 
 BASE_URL = "https://chat.openai.com/"
 
+# Refresh the access token when it expires within this many seconds
+REFRESH_MARGIN = 300
+
+# The background refresher renews credentials this many seconds before expiry,
+# ahead of the request path
+BACKGROUND_MARGIN = REFRESH_MARGIN * 2
+
+# Shortest wait between two background refreshes, in seconds
+MIN_REFRESH_INTERVAL = 60
+
+# Cookies set during clearance and login
+COOKIE_PATTERN = re.compile(
+    r"(cf_clearance|_puid|__Secure-next-auth\.session-token)=([^;\n]*)",
+)
+
+# Static assets that are not needed to obtain clearance in lean mode
+BLOCKED_URLS = [
+    "*.png",
+    "*.jpg",
+    "*.jpeg",
+    "*.gif",
+    "*.webp",
+    "*.svg",
+    "*.ico",
+    "*.woff",
+    "*.woff2",
+    "*.ttf",
+    "*.css",
+    "*.mp4",
+]
+
 
 class Chrome(uc.Chrome):
     def __del__(self):
         self.quit()
 
 
+class WarmBrowser:
+    """
+    Keeps one browser alive and reuses it for clearance refreshes and logins
+    """
+
+    def __init__(
+        self,
+        get_options,
+        driver_executable_path=None,
+        browser_executable_path=None,
+        max_uses=20,
+        max_memory=None,
+    ) -> None:
+        """
+        :param get_options: Callable returning fresh ChromeOptions
+        :param max_uses: Restart the browser after this many sessions
+        :param max_memory: Restart the browser once it uses more bytes than this
+        """
+        self.get_options = get_options
+        self.driver_executable_path = driver_executable_path
+        self.browser_executable_path = browser_executable_path
+        self.max_uses = max_uses
+        self.max_memory = max_memory
+        self.driver = None
+        self.uses = 0
+        self.lock = threading.Lock()
+
+    def __start(self):
+        print("Spawning browser...")
+        self.driver = uc.Chrome(
+            enable_cdp_events=True,
+            options=self.get_options(),
+            driver_executable_path=self.driver_executable_path,
+            browser_executable_path=self.browser_executable_path,
+        )
+        self.uses = 0
+        print("Browser spawned.")
+
+    def __is_healthy(self):
+        try:
+            self.driver.current_url
+        except Exception:
+            return False
+        return True
+
+    def __memory(self):
+        """
+        Resident memory of the browser process in bytes, if it can be read
+        """
+        try:
+            with open(f"/proc/{self.driver.browser_pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except (OSError, AttributeError, ValueError):
+            pass
+        return None
+
+    def __needs_restart(self):
+        if self.driver is None or self.uses >= self.max_uses:
+            return True
+        if not self.__is_healthy():
+            return True
+        if self.max_memory is not None:
+            memory = self.__memory()
+            if memory is not None and memory > self.max_memory:
+                return True
+        return False
+
+    @contextmanager
+    def session(self):
+        """
+        Borrow the browser, starting or recycling it first if needed
+        """
+        with self.lock:
+            if self.__needs_restart():
+                self.quit()
+                self.__start()
+            self.uses += 1
+            try:
+                yield self.driver
+            except BaseException:
+                # The page may be in any state, so don't hand it out again
+                self.quit()
+                raise
+            finally:
+                reactor = getattr(self.driver, "reactor", None)
+                if reactor is not None:
+                    reactor.handlers.clear()
+
+    def quit(self):
+        """
+        Close the browser
+        """
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            except Exception:
+                pass
+            self.driver = None
+
+
+class BrokerClient:
+    """
+    Client of a clearance broker started with revChatGPT-broker
+    """
+
+    def __init__(self, path, timeout=600) -> None:
+        self.path = path
+        self.timeout = timeout
+
+    def __request(self, request):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            with sock.makefile("rb") as f:
+                response = json.loads(f.readline())
+        if "error" in response:
+            raise Exception(f"Clearance broker error: {response['error']}")
+        return response
+
+    def get(self):
+        """
+        Get the current clearance
+        """
+        return self.__request({"op": "get"})
+
+    def refresh(self, cf_clearance=None):
+        """
+        Report a clearance as rejected and get a fresh one
+        """
+        return self.__request({"op": "refresh", "cf_clearance": cf_clearance})
+
+
+class ClearanceCache:
+    """
+    On-disk cache of Cloudflare clearance, shared by processes through a file lock
+    """
+
+    def __init__(self, path=None, ttl=1800) -> None:
+        if path is None:
+            cache_home = os.getenv("XDG_CACHE_HOME") or os.path.join(
+                os.path.expanduser("~"),
+                ".cache",
+            )
+            path = os.path.join(cache_home, "revChatGPT", "clearance.json")
+        self.path = path
+        self.ttl = ttl
+
+    @contextmanager
+    def __locked(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".lock", "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def __read(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def __write(self, entries):
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        # Private from creation, so the cookies are never readable by others
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        if hasattr(os, "fchmod"):
+            # A temp file left over by a crashed run keeps its old mode
+            os.fchmod(fd, 0o600)
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump(entries, f)
+        os.replace(temp_path, self.path)
+
+    def get(self, proxy=None):
+        """
+        Get the cached clearance for a proxy, or None if it is missing or expired
+        """
+        with self.__locked():
+            entry = self.__read().get(proxy or "")
+        if entry is None or entry["expires"] <= time():
+            return None
+        return entry
+
+    def set(self, cf_clearance, puid_cookie, user_agent, proxy=None):
+        """
+        Cache the clearance for a proxy
+        """
+        with self.__locked():
+            entries = self.__read()
+            entries[proxy or ""] = {
+                "cf_clearance": cf_clearance,
+                "puid_cookie": puid_cookie,
+                "user_agent": user_agent,
+                "proxy": proxy,
+                "expires": time() + self.ttl,
+            }
+            self.__write(entries)
+
+    def invalidate(self, proxy=None, cf_clearance=None):
+        """
+        Drop the cached clearance for a proxy, if it is still the one given
+        """
+        with self.__locked():
+            entries = self.__read()
+            entry = entries.get(proxy or "")
+            if entry is None:
+                return
+            if cf_clearance is None or entry["cf_clearance"] == cf_clearance:
+                del entries[proxy or ""]
+                self.__write(entries)
+
+
 class Chatbot:
     def __init__(
         self,
@@ -29,19 +299,30 @@ class Chatbot:
         conversation_id=None,
         parent_id=None,
         no_refresh=False,
+        tracer=None,
     ) -> None:
         self.config = config
-        self.session = tls_client.Session(
-            client_identifier="chrome_108",
-        )
         if "proxy" in config:
             if type(config["proxy"]) != str:
                 raise Exception("Proxy must be a string!")
-            proxies = {
-                "http": config["proxy"],
-                "https": config["proxy"],
-            }
-            self.session.proxies.update(proxies)
+        # Hooks registered on the tracer receive timed spans and events
+        self.tracer = tracer or Tracer()
+        self.transport = TLSClientTransport(
+            proxy=config.get("proxy"),
+            timeout=180,
+            tracer=self.tracer,
+        )
+        # Cookies and headers live on the underlying tls_client session
+        self.session = self.transport.session
+        # tls_client cannot stream, so answers are read through requests with
+        # the same cookies and headers unless "stream" is disabled
+        self.stream_transport = None
+        if config.get("stream", True):
+            self.stream_transport = RequestsTransport(
+                proxy=config.get("proxy"),
+                timeout=180,
+                tracer=self.tracer,
+            )
         if "verbose" in config:
             if type(config["verbose"]) != bool:
                 raise Exception("Verbose must be a boolean!")
@@ -54,6 +335,50 @@ class Chatbot:
         self.conversation_id_prev_queue = []
         self.parent_id_prev_queue = []
         self.isMicrosoftLogin = False
+        self.cf_clearance = None
+        self.puid_cookie = None
+        self.user_agent = None
+        # Unix time the current clearance is considered expired, 0 if unknown
+        self.clearance_expiry = 0
+        self.clearance_ttl = config.get("clearance_ttl", 1800)
+        self.clearance_cache = None
+        if config.get("clearance_cache"):
+            self.clearance_cache = ClearanceCache(
+                path=config["clearance_cache"]
+                if isinstance(config["clearance_cache"], str)
+                else None,
+                ttl=self.clearance_ttl,
+            )
+        self.clearance_broker = None
+        if config.get("clearance_broker"):
+            self.clearance_broker = BrokerClient(config["clearance_broker"])
+        # Overall time limit of a clearance or login flow, in seconds
+        self.login_timeout = config.get("login_timeout", 300)
+        self.warm_browser = None
+        # A browser passed in the config belongs to the caller, who quits it
+        self.owns_warm_browser = False
+        if isinstance(config.get("warm_browser"), WarmBrowser):
+            self.warm_browser = config["warm_browser"]
+        elif config.get("warm_browser"):
+            self.owns_warm_browser = True
+            self.warm_browser = WarmBrowser(
+                self.__get_ChromeOptions,
+                driver_executable_path=config.get("driver_exec_path"),
+                browser_executable_path=config.get("browser_exec_path"),
+                max_uses=config.get("browser_max_uses", 20),
+                max_memory=config.get("browser_max_memory"),
+            )
+        # Unix time the current access token expires, 0 if there is none
+        self.access_token_expiry = 0
+        # Seconds the current access token was valid for when it was issued
+        self.access_token_lifetime = 0
+        # Held while credentials are being refreshed
+        self.refresh_lock = threading.RLock()
+        # Held while reading or updating the current conversation and parent
+        self.state_lock = threading.Lock()
+        # Held while reading or replacing the session cookies and headers
+        self.credentials_lock = threading.RLock()
+        self.background_stop = threading.Event()
         # stdout colors
         self.GREEN = "\033[92m"
         self.WARNING = "\033[93m"
@@ -82,21 +407,102 @@ class Chatbot:
                 config["session_token"],
             )
             self.__get_cf_cookies()
+        elif no_refresh:
+            # Only used to obtain clearance
+            self.__get_cf_cookies()
+            return
         else:
             raise Exception("Invalid config!")
         self.__retry_refresh()
+        if config.get("background_refresh"):
+            threading.Thread(target=self.__background_refresh, daemon=True).start()
+
+    def close(self):
+        """
+        Stop the background refresher and quit the warm browser this created
+        """
+        self.background_stop.set()
+        if self.owns_warm_browser:
+            self.warm_browser.quit()
+
+    def __background_refresh(self):
+        """
+        Renew the clearance and access token before they expire, off the request path
+        """
+        delay = 0
+        while not self.background_stop.wait(delay):
+            try:
+                with self.refresh_lock:
+                    if self.clearance_expiry and time() >= self.__refresh_time(
+                        self.clearance_expiry,
+                        self.clearance_ttl,
+                    ):
+                        self.__get_cf_cookies(rejected=True)
+                    if time() >= self.__refresh_time(
+                        self.access_token_expiry,
+                        self.access_token_lifetime,
+                    ):
+                        self.__retry_refresh()
+                due = self.__refresh_time(
+                    self.access_token_expiry,
+                    self.access_token_lifetime,
+                )
+                if self.clearance_expiry:
+                    due = min(
+                        due,
+                        self.__refresh_time(self.clearance_expiry, self.clearance_ttl),
+                    )
+                # Short-lived or unrefreshable credentials must not cause a busy loop
+                delay = max(due - time(), MIN_REFRESH_INTERVAL)
+            except Exception as exc:
+                print(f"Background refresh failed: {exc}")
+                delay = MIN_REFRESH_INTERVAL
+
+    @staticmethod
+    def __refresh_time(expiry, lifetime):
+        """
+        Time to renew a credential in the background: BACKGROUND_MARGIN before
+        it expires, or a quarter of its lifetime before if that is shorter
+        """
+        return expiry - min(BACKGROUND_MARGIN, lifetime * 0.25)
+
+    def __ensure_session(self):
+        """
+        Refresh the session only if the access token is missing or about to expire
+        """
+        if time() >= self.access_token_expiry - REFRESH_MARGIN:
+            with self.refresh_lock:
+                # Another thread may have refreshed while we waited
+                if time() >= self.access_token_expiry - REFRESH_MARGIN:
+                    self.__retry_refresh()
+
+    @staticmethod
+    def __get_token_expiry(access_token):
+        """
+        Read the expiry from the access token, which is a JWT
+        """
+        try:
+            payload = access_token.split(".")[1]
+            payload += "=" * (-len(payload) % 4)
+            return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+        except Exception:
+            # Unknown format, so only trust it for a short while
+            return time() + REFRESH_MARGIN * 2
 
     def __retry_refresh(self):
         retries = 5
         refresh = True
-        while refresh:
-            try:
-                self.__refresh_session()
-                refresh = False
-            except Exception as exc:
-                if retries == 0:
-                    raise exc
-                retries -= 1
+        with self.tracer.span("auth_refresh") as span:
+            while refresh:
+                try:
+                    self.__refresh_session()
+                    refresh = False
+                except Exception as exc:
+                    if retries == 0:
+                        raise exc
+                    retries -= 1
+            if span is not None:
+                span["retries"] = 5 - retries
 
     def ask(
         self,
@@ -105,6 +511,7 @@ class Chatbot:
         parent_id=None,
         gen_title=False,
         session_token=None,
+        new_conversation=False,
     ):
         """
         Ask a question to the chatbot
@@ -113,6 +520,51 @@ class Chatbot:
         :param parent_id: UUID
         :param gen_title: Boolean
         :param session_token: String
+        :param new_conversation: Start a new conversation instead of the current one
+        """
+        new_conv = new_conversation or (conversation_id or self.conversation_id) is None
+        res = None
+        for res in self.ask_stream(
+            prompt,
+            conversation_id=conversation_id,
+            parent_id=parent_id,
+            session_token=session_token,
+            new_conversation=new_conversation,
+        ):
+            pass
+        if res is None:
+            return None
+        if gen_title and new_conv:
+            try:
+                with self.tracer.span(
+                    "gen_title",
+                    conversation_id=res["conversation_id"],
+                ):
+                    title = self.__gen_title(
+                        res["conversation_id"],
+                        res["parent_id"],
+                    )["title"]
+            except Exception as exc:
+                split = prompt.split(" ")
+                title = " ".join(split[:3]) + ("..." if len(split) > 3 else "")
+            res["title"] = title
+        return res
+
+    def ask_stream(
+        self,
+        prompt,
+        conversation_id=None,
+        parent_id=None,
+        session_token=None,
+        new_conversation=False,
+    ):
+        """
+        Ask a question to the chatbot, yielding the response as it is parsed
+        :param prompt: String
+        :param conversation_id: UUID
+        :param parent_id: UUID
+        :param session_token: String
+        :param new_conversation: Start a new conversation instead of the current one
         """
         if session_token:
             self.session.cookies.set(
@@ -121,16 +573,22 @@ class Chatbot:
             )
             self.session_token = session_token
             self.config["session_token"] = session_token
-        self.__retry_refresh()
-        self.__map_conversations()
-        if conversation_id == None:
-            conversation_id = self.conversation_id
-        if parent_id == None:
-            parent_id = (
-                self.parent_id
-                if conversation_id == self.conversation_id
-                else self.conversation_mapping[conversation_id]
-            )
+            self.access_token_expiry = 0
+        self.__ensure_session()
+        with self.state_lock:
+            if new_conversation:
+                current = True
+            else:
+                if conversation_id == None:
+                    conversation_id = self.conversation_id
+                current = conversation_id == self.conversation_id
+                if parent_id == None and current:
+                    parent_id = self.parent_id
+        if parent_id == None and not current:
+            if conversation_id not in self.conversation_mapping:
+                with self.tracer.span("mapping", conversation_id=conversation_id):
+                    self.__map_conversation(conversation_id)
+            parent_id = self.conversation_mapping[conversation_id]
         data = {
             "action": "next",
             "messages": [
@@ -146,58 +604,106 @@ class Chatbot:
             if self.config.get("paid") is not True
             else "text-davinci-002-render-paid",
         }
-        new_conv = data["conversation_id"] is None
         self.conversation_id_prev_queue.append(
             data["conversation_id"],
         )  # for rollback
         self.parent_id_prev_queue.append(data["parent_message_id"])
-        response = self.session.post(
-            url=BASE_URL + "backend-api/conversation",
-            data=json.dumps(data),
-            timeout_seconds=180,
-        )
-        if response.status_code != 200:
-            print(response.text)
-            self.__refresh_session()
-            raise HTTPError(
-                f"Wrong response code: {response.status_code}! Refreshing session...",
+        if self.stream_transport is None:
+            response = self.__request(
+                "POST",
+                BASE_URL + "backend-api/conversation",
+                data=json.dumps(data),
             )
         else:
+            response = self.__request(
+                "POST",
+                BASE_URL + "backend-api/conversation",
+                transport=self.stream_transport,
+                data=json.dumps(data),
+                stream=True,
+            )
+        try:
+            if response.status_code != 200:
+                print(response.text)
+                with self.refresh_lock:
+                    self.access_token_expiry = 0
+                    self.__refresh_session()
+                raise HTTPError(
+                    f"Wrong response code: {response.status_code}! Refreshing session...",
+                )
+            events = 0
+            for event in self.__parse_events(self.__lines(response)):
+                with self.state_lock:
+                    self.parent_id = event["parent_id"]
+                    self.conversation_id = event["conversation_id"]
+                events += 1
+                if self.tracer:
+                    self.tracer.event(
+                        "event",
+                        index=events,
+                        length=len(event["message"]),
+                    )
+                yield event
+        finally:
+            if self.stream_transport is not None:
+                response.close()
+        self.tracer.event("stream_end", events=events)
+        if events:
+            # The next turn of this conversation continues from this reply
+            self.conversation_mapping[event["conversation_id"]] = event["parent_id"]
+
+    def __request(self, method, url, transport=None, **kwargs):
+        """
+        Send a request with a consistent snapshot of the session credentials
+        """
+        with self.credentials_lock:
+            headers = dict(self.session.headers)
+            cookies = self.session.cookies.get_dict()
+        return (transport or self.transport).request(
+            method,
+            url,
+            headers=headers,
+            cookies=cookies,
+            **kwargs,
+        )
+
+    def __lines(self, response):
+        """
+        Lines of the response body, as they arrive when it is streamed
+        """
+        if self.stream_transport is None:
+            # tls_client has already read the whole body, so there is no
+            # first byte to report
+            yield from response.text.splitlines()
+            return
+        response.encoding = "utf-8"
+        first_byte = bool(self.tracer)
+        for line in response.iter_lines(decode_unicode=True):
+            if first_byte:
+                first_byte = False
+                self.tracer.event("first_byte")
+            yield line
+
+    @staticmethod
+    def __parse_events(lines):
+        """
+        Parse server-sent events into message updates
+        """
+        for line in lines:
+            if not line.startswith("data: "):
+                continue
+            line = line[6:]
+            if line == "[DONE]":
+                break
             try:
-                response = response.text.splitlines()[-4]
-                response = response[6:]
-            except Exception as exc:
-                print("Incorrect response from OpenAI API")
-                raise Exception("Incorrect response from OpenAI API") from exc
-            # Check if it is JSON
-            if response.startswith("{"):
-                response = json.loads(response)
-                self.parent_id = response["message"]["id"]
-                self.conversation_id = response["conversation_id"]
-                message = response["message"]["content"]["parts"][0]
-                res = {
-                    "message": message,
-                    "conversation_id": self.conversation_id,
-                    "parent_id": self.parent_id,
+                line = json.loads(line)
+                yield {
+                    "message": line["message"]["content"]["parts"][0],
+                    "conversation_id": line["conversation_id"],
+                    "parent_id": line["message"]["id"],
                 }
-                if gen_title and new_conv:
-                    try:
-                        title = self.__gen_title(
-                            self.conversation_id,
-                            self.parent_id,
-                        )["title"]
-                    except Exception as exc:
-                        split = prompt.split(" ")
-                        title = " ".join(split[:3]) + ("..." if len(split) > 3 else "")
-                    res["title"] = title
-                return res
-            else:
-                return None
-
-    def __check_response(self, response):
-        if response.status_code != 200:
-            print(response.text)
-            raise Exception("Response code error: ", response.status_code)
+            except (json.decoder.JSONDecodeError, KeyError, TypeError, IndexError):
+                continue
 
     def get_conversations(self, offset=0, limit=20):
         """
@@ -206,8 +712,8 @@ class Chatbot:
         :param limit: Integer
         """
         url = BASE_URL + f"backend-api/conversations?offset={offset}&limit={limit}"
-        response = self.session.get(url)
-        self.__check_response(response)
+        response = self.__request("GET", url)
+        check_response(response)
         data = json.loads(response.text)
         return data["items"]
 
@@ -217,8 +723,8 @@ class Chatbot:
         :param id: UUID of conversation
         """
         url = BASE_URL + f"backend-api/conversation/{id}"
-        response = self.session.get(url)
-        self.__check_response(response)
+        response = self.__request("GET", url)
+        check_response(response)
         data = json.loads(response.text)
         return data
 
@@ -227,7 +733,8 @@ class Chatbot:
         Generate title for conversation
         """
         url = BASE_URL + f"backend-api/conversation/gen_title/{id}"
-        response = self.session.post(
+        response = self.__request(
+            "POST",
             url,
             data=json.dumps(
                 {
@@ -238,7 +745,7 @@ class Chatbot:
                 },
             ),
         )
-        self.__check_response(response)
+        check_response(response)
         data = json.loads(response.text)
         return data
 
@@ -249,8 +756,8 @@ class Chatbot:
         :param title: String
         """
         url = BASE_URL + f"backend-api/conversation/{id}"
-        response = self.session.patch(url, data=f'{{"title": "{title}"}}')
-        self.__check_response(response)
+        response = self.__request("PATCH", url, data=f'{{"title": "{title}"}}')
+        check_response(response)
 
     def delete_conversation(self, id):
         """
@@ -258,22 +765,19 @@ class Chatbot:
         :param id: UUID of conversation
         """
         url = BASE_URL + f"backend-api/conversation/{id}"
-        response = self.session.patch(url, data='{"is_visible": false}')
-        self.__check_response(response)
+        response = self.__request("PATCH", url, data='{"is_visible": false}')
+        check_response(response)
 
     def clear_conversations(self):
         """
         Delete all conversations
         """
         url = BASE_URL + "backend-api/conversations"
-        response = self.session.patch(url, data='{"is_visible": false}')
-        self.__check_response(response)
+        response = self.__request("PATCH", url, data='{"is_visible": false}')
+        check_response(response)
 
-    def __map_conversations(self):
-        conversations = self.get_conversations()
-        histories = [self.get_msg_history(x["id"]) for x in conversations]
-        for x, y in zip(conversations, histories):
-            self.conversation_mapping[x["id"]] = y["current_node"]
+    def __map_conversation(self, id):
+        self.conversation_mapping[id] = self.get_msg_history(id)["current_node"]
 
     def __refresh_session(self, session_token=None):
         if session_token:
@@ -284,9 +788,9 @@ class Chatbot:
             self.session_token = session_token
             self.config["session_token"] = session_token
         url = BASE_URL + "api/auth/session"
-        response = self.session.get(url, timeout_seconds=180)
+        response = self.__request("GET", url)
         if response.status_code == 403:
-            self.__get_cf_cookies()
+            self.__get_cf_cookies(rejected=True)
             raise Exception("Clearance refreshing...")
         try:
             if "error" in response.json():
@@ -302,10 +806,12 @@ class Chatbot:
                     f"Response code: {response.status_code} \n Response: {response.text}",
                 )
             else:
-                self.session.headers.update(
-                    {
-                        "Authorization": "Bearer " + response.json()["accessToken"],
-                    },
+                access_token = response.json()["accessToken"]
+                self.__swap_headers({"Authorization": "Bearer " + access_token})
+                self.access_token_expiry = self.__get_token_expiry(access_token)
+                self.access_token_lifetime = max(
+                    self.access_token_expiry - time(),
+                    0,
                 )
             self.session_token = self.session.cookies._find(
                 "__Secure-next-auth.session-token",
@@ -333,25 +839,9 @@ class Chatbot:
 
         :return: None
         """
-        driver = None
-        try:
-            # Open the browser
-            self.cf_cookie_found = False
-            self.puid_cookie_found = False
-            self.session_cookie_found = False
-            self.agent_found = False
-            self.cf_clearance = None
-            self.puid_cookie = None
-            self.user_agent = None
-            options = self.__get_ChromeOptions()
-            print("Spawning browser...")
-            driver = uc.Chrome(
-                enable_cdp_events=True,
-                options=options,
-                driver_executable_path=self.config.get("driver_exec_path"),
-                browser_executable_path=self.config.get("browser_exec_path"),
-            )
-            print("Browser spawned.")
+        with self.__browser(login=True) as driver:
+            deadline = time() + self.login_timeout
+            self.__reset_detection()
             driver.add_cdp_listener(
                 "Network.responseReceivedExtraInfo",
                 lambda msg: self.__detect_cookies(msg),
@@ -361,15 +851,9 @@ class Chatbot:
                 lambda msg: self.__detect_user_agent(msg),
             )
             driver.get(BASE_URL)
-            while not self.agent_found or not self.cf_cookie_found:
-                sleep(5)
-            self.__refresh_headers(
-                cf_clearance=self.cf_clearance,
-                puid_cookie=self.puid_cookie,
-                user_agent=self.user_agent,
-            )
+            self.__wait_for(deadline, self.agent_found, self.cf_cookie_found)
             # Wait for the login button to appear
-            WebDriverWait(driver, 120).until(
+            WebDriverWait(driver, self.__remaining(deadline)).until(
                 EC.element_to_be_clickable(
                     (By.XPATH, "//button[contains(text(), 'Log in')]"),
                 ),
@@ -380,7 +864,7 @@ class Chatbot:
                 value="//button[contains(text(), 'Log in')]",
             ).click()
             # Wait for the Login with Microsoft button to be clickable
-            WebDriverWait(driver, 60).until(
+            WebDriverWait(driver, self.__remaining(deadline)).until(
                 EC.element_to_be_clickable(
                     (By.XPATH, "//button[@data-provider='windowslive']"),
                 ),
@@ -391,7 +875,7 @@ class Chatbot:
                 value="//button[@data-provider='windowslive']",
             ).click()
             # Wait for the email input field to appear
-            WebDriverWait(driver, 60).until(
+            WebDriverWait(driver, self.__remaining(deadline)).until(
                 EC.visibility_of_element_located(
                     (By.XPATH, "//input[@type='email']"),
                 ),
@@ -402,7 +886,7 @@ class Chatbot:
                 value="//input[@type='email']",
             ).send_keys(self.config["email"])
             # Wait for the Next button to be clickable
-            WebDriverWait(driver, 60).until(
+            WebDriverWait(driver, self.__remaining(deadline)).until(
                 EC.element_to_be_clickable(
                     (By.XPATH, "//input[@type='submit']"),
                 ),
@@ -413,7 +897,7 @@ class Chatbot:
                 value="//input[@type='submit']",
             ).click()
             # Wait for the password input field to appear
-            WebDriverWait(driver, 60).until(
+            WebDriverWait(driver, self.__remaining(deadline)).until(
                 EC.visibility_of_element_located(
                     (By.XPATH, "//input[@type='password']"),
                 ),
@@ -424,7 +908,7 @@ class Chatbot:
                 value="//input[@type='password']",
             ).send_keys(self.config["password"])
             # Wait for the Sign in button to be clickable
-            WebDriverWait(driver, 60).until(
+            WebDriverWait(driver, self.__remaining(deadline)).until(
                 EC.element_to_be_clickable(
                     (By.XPATH, "//input[@type='submit']"),
                 ),
@@ -435,7 +919,7 @@ class Chatbot:
                 value="//input[@type='submit']",
             ).click()
             # Wait for the Allow button to appear
-            WebDriverWait(driver, 60).until(
+            WebDriverWait(driver, self.__remaining(deadline)).until(
                 EC.element_to_be_clickable(
                     (By.XPATH, "//input[@type='submit']"),
                 ),
@@ -446,19 +930,14 @@ class Chatbot:
                 value="//input[@type='submit']",
             ).click()
             # wait for input box to appear (to make sure we're signed in)
-            WebDriverWait(driver, 60).until(
+            WebDriverWait(driver, self.__remaining(deadline)).until(
                 EC.visibility_of_element_located(
                     (By.XPATH, "//textarea"),
                 ),
             )
-            while not self.session_cookie_found:
-                sleep(5)
+            self.__wait_for(deadline, self.session_cookie_found)
+            self.__apply_detected()
             print(self.GREEN + "Login successful." + self.ENDCOLOR)
-        finally:
-            # Close the browser
-            if driver is not None:
-                driver.quit()
-                del driver
 
     def __email_login(self) -> None:
         """
@@ -466,25 +945,9 @@ class Chatbot:
 
         :return: None
         """
-        # Open the browser
-        driver = None
-        try:
-            self.cf_cookie_found = False
-            self.puid_cookie_found = False
-            self.session_cookie_found = False
-            self.agent_found = False
-            self.cf_clearance = None
-            self.puid_cookie = None
-            self.user_agent = None
-            options = self.__get_ChromeOptions()
-            print("Spawning browser...")
-            driver = uc.Chrome(
-                enable_cdp_events=True,
-                options=options,
-                driver_executable_path=self.config.get("driver_exec_path"),
-                browser_executable_path=self.config.get("browser_exec_path"),
-            )
-            print("Browser spawned.")
+        with self.__browser(login=True) as driver:
+            deadline = time() + self.login_timeout
+            self.__reset_detection()
             driver.add_cdp_listener(
                 "Network.responseReceivedExtraInfo",
                 lambda msg: self.__detect_cookies(msg),
@@ -494,15 +957,9 @@ class Chatbot:
                 lambda msg: self.__detect_user_agent(msg),
             )
             driver.get(BASE_URL)
-            while not self.agent_found or not self.cf_cookie_found:
-                sleep(5)
-            self.__refresh_headers(
-                cf_clearance=self.cf_clearance,
-                puid_cookie=self.puid_cookie,
-                user_agent=self.user_agent,
-            )
+            self.__wait_for(deadline, self.agent_found, self.cf_cookie_found)
             # Wait for the login button to appear
-            WebDriverWait(driver, 120).until(
+            WebDriverWait(driver, self.__remaining(deadline)).until(
                 EC.element_to_be_clickable(
                     (By.XPATH, "//button[contains(text(), 'Log in')]"),
                 ),
@@ -513,7 +970,7 @@ class Chatbot:
                 value="//button[contains(text(), 'Log in')]",
             ).click()
             # Wait for the email input field to appear
-            WebDriverWait(driver, 60).until(
+            WebDriverWait(driver, self.__remaining(deadline)).until(
                 EC.visibility_of_element_located(
                     (By.ID, "username"),
                 ),
@@ -523,7 +980,7 @@ class Chatbot:
                 self.config["email"],
             )
             # Wait for the Continue button to be clickable
-            WebDriverWait(driver, 60).until(
+            WebDriverWait(driver, self.__remaining(deadline)).until(
                 EC.element_to_be_clickable(
                     (By.XPATH, "//button[@type='submit']"),
                 ),
@@ -534,7 +991,7 @@ class Chatbot:
                 value="//button[@type='submit']",
             ).click()
             # Wait for the password input field to appear
-            WebDriverWait(driver, 60).until(
+            WebDriverWait(driver, self.__remaining(deadline)).until(
                 EC.visibility_of_element_located(
                     (By.ID, "password"),
                 ),
@@ -544,7 +1001,7 @@ class Chatbot:
                 self.config["password"],
             )
             # Wait for the Sign in button to be clickable
-            WebDriverWait(driver, 60).until(
+            WebDriverWait(driver, self.__remaining(deadline)).until(
                 EC.element_to_be_clickable(
                     (By.XPATH, "//button[@type='submit']"),
                 ),
@@ -555,19 +1012,68 @@ class Chatbot:
                 value="//button[@type='submit']",
             ).click()
             # wait for input box to appear (to make sure we're signed in)
-            WebDriverWait(driver, 60).until(
+            WebDriverWait(driver, self.__remaining(deadline)).until(
                 EC.visibility_of_element_located(
                     (By.XPATH, "//textarea"),
                 ),
             )
-            while not self.session_cookie_found or not self.puid_cookie_found:
-                sleep(5)
+            self.__wait_for(
+                deadline,
+                self.session_cookie_found,
+                self.puid_cookie_found,
+            )
+            self.__apply_detected()
             print(self.GREEN + "Login successful." + self.ENDCOLOR)
-        finally:
-            if driver is not None:
-                # Close the browser
-                driver.quit()
-                del driver
+
+    def __reset_detection(self):
+        """
+        Forget detected cookies and user agent before watching a new page load.
+        They are collected apart from the credentials in use, which only
+        change once the flow succeeds.
+        """
+        self.cf_cookie_found = threading.Event()
+        self.puid_cookie_found = threading.Event()
+        self.session_cookie_found = threading.Event()
+        self.agent_found = threading.Event()
+        self.detected = {}
+
+    def __apply_detected(self):
+        """
+        Switch to the credentials detected by a successful browser flow
+        """
+        detected = self.detected
+        self.cf_clearance = detected.get("cf_clearance", self.cf_clearance)
+        self.puid_cookie = detected.get("puid_cookie", self.puid_cookie)
+        self.user_agent = detected.get("user_agent", self.user_agent)
+        if "session_token" in detected:
+            self.session_token = detected["session_token"]
+            self.session.cookies.set(
+                "__Secure-next-auth.session-token",
+                self.session_token,
+            )
+        self.__refresh_headers(
+            cf_clearance=self.cf_clearance,
+            puid_cookie=self.puid_cookie,
+            user_agent=self.user_agent,
+        )
+
+    @staticmethod
+    def __remaining(deadline):
+        return max(deadline - time(), 0)
+
+    def __wait_for(self, deadline, *events):
+        """
+        Wait until the CDP listeners have set every event, or the deadline passes
+        """
+        for event in events:
+            if not event.wait(self.__remaining(deadline)):
+                raise TimeoutError("Timed out waiting for the browser")
+
+    @staticmethod
+    def __detach_listeners(driver):
+        reactor = getattr(driver, "reactor", None)
+        if reactor is not None:
+            reactor.handlers.clear()
 
     def __get_ChromeOptions(self):
         options = uc.ChromeOptions()
@@ -582,150 +1088,215 @@ class Chatbot:
             options.add_argument("--proxy-server=" + self.config["proxy"])
         return options
 
-    def __get_cf_cookies(self) -> None:
+    @contextmanager
+    def __browser(self, login=False):
         """
-        Get cloudflare cookies.
-
-        :return: None
+        Get a browser, reusing the warm one if there is one
         """
+        if self.warm_browser is not None:
+            with self.warm_browser.session() as driver:
+                if login:
+                    # Start logins from a clean slate
+                    driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+                yield driver
+            return
         driver = None
         try:
-            self.cf_cookie_found = False
-            self.agent_found = False
-            self.puid_cookie_found = False
-            self.cf_clearance = None
-            self.puid_cookie = None
-            self.user_agent = None
-            options = self.__get_ChromeOptions()
             print("Spawning browser...")
             driver = uc.Chrome(
                 enable_cdp_events=True,
-                options=options,
+                options=self.__get_ChromeOptions(),
                 driver_executable_path=self.config.get("driver_exec_path"),
                 browser_executable_path=self.config.get("browser_exec_path"),
             )
             print("Browser spawned.")
-            driver.add_cdp_listener(
-                "Network.responseReceivedExtraInfo",
-                lambda msg: self.__detect_cookies(msg),
-            )
-            driver.add_cdp_listener(
-                "Network.requestWillBeSentExtraInfo",
-                lambda msg: self.__detect_user_agent(msg),
-            )
-            driver.get("https://chat.openai.com/chat")
-            while (
-                not self.agent_found
-                or not self.cf_cookie_found
-                or not self.puid_cookie_found
-            ):
-                sleep(5)
+            yield driver
         finally:
             # Close the browser
             if driver is not None:
                 driver.quit()
                 del driver
+
+    def get_clearance(self):
+        """
+        Get the Cloudflare clearance currently in use
+        """
+        return {
+            "cf_clearance": self.cf_clearance,
+            "puid_cookie": self.puid_cookie,
+            "user_agent": self.user_agent,
+        }
+
+    def refresh_clearance(self):
+        """
+        Drop the current Cloudflare clearance and obtain a new one
+        """
+        self.__get_cf_cookies(rejected=True)
+        return self.get_clearance()
+
+    def __get_cf_cookies(self, rejected=False) -> None:
+        """
+        Get cloudflare cookies.
+
+        :param rejected: Whether the current clearance was rejected
+        :return: None
+        """
+        if self.clearance_broker is not None:
+            if rejected:
+                clearance = self.clearance_broker.refresh(self.cf_clearance)
+            else:
+                clearance = self.clearance_broker.get()
+            self.cf_clearance = clearance["cf_clearance"]
+            self.puid_cookie = clearance["puid_cookie"]
+            self.user_agent = clearance["user_agent"]
+            self.clearance_expiry = clearance.get("expires") or 0
             self.__refresh_headers(
                 cf_clearance=self.cf_clearance,
                 puid_cookie=self.puid_cookie,
                 user_agent=self.user_agent,
             )
+            return
+        if rejected and self.clearance_cache is not None:
+            self.clearance_cache.invalidate(
+                self.config.get("proxy"),
+                self.cf_clearance,
+            )
+        if self.clearance_cache is not None:
+            cached = self.clearance_cache.get(self.config.get("proxy"))
+            if cached is not None:
+                self.cf_clearance = cached["cf_clearance"]
+                self.puid_cookie = cached["puid_cookie"]
+                self.user_agent = cached["user_agent"]
+                self.clearance_expiry = cached["expires"]
+                self.__refresh_headers(
+                    cf_clearance=self.cf_clearance,
+                    puid_cookie=self.puid_cookie,
+                    user_agent=self.user_agent,
+                )
+                return
+        deadline = time() + self.login_timeout
+        self.__reset_detection()
+        with self.__browser() as driver:
+            driver.add_cdp_listener(
+                "Network.responseReceivedExtraInfo",
+                lambda msg: self.__detect_cookies(msg),
+            )
+            driver.add_cdp_listener(
+                "Network.requestWillBeSentExtraInfo",
+                lambda msg: self.__detect_user_agent(msg),
+            )
+            lean = self.config.get("lean_clearance", False)
+            if lean:
+                # Only the headers matter, so skip downloading static assets
+                driver.execute_cdp_cmd("Network.enable", {})
+                driver.execute_cdp_cmd(
+                    "Network.setBlockedURLs",
+                    {"urls": BLOCKED_URLS},
+                )
+            # A warm browser may still hold a valid clearance, and Cloudflare
+            # only sends a new one to browsers without it
+            driver.execute_cdp_cmd(
+                "Network.deleteCookies",
+                {"name": "cf_clearance", "url": BASE_URL},
+            )
+            try:
+                driver.get("https://chat.openai.com/chat")
+                self.__wait_for(
+                    deadline,
+                    self.agent_found,
+                    self.cf_cookie_found,
+                    self.puid_cookie_found,
+                )
+                # Stop parsing every network event of the rest of the page load
+                self.__detach_listeners(driver)
+            finally:
+                if lean:
+                    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": []})
+        # On failure the exception propagates and the old clearance stays in use
+        self.__apply_detected()
+        self.clearance_expiry = time() + self.clearance_ttl
+        if self.clearance_cache is not None:
+            self.clearance_cache.set(
+                self.cf_clearance,
+                self.puid_cookie,
+                self.user_agent,
+                proxy=self.config.get("proxy"),
+            )
 
     def __detect_cookies(self, message):
-        if "params" in message:
-            if "headers" in message["params"]:
-                if "set-cookie" in message["params"]["headers"]:
-                    # Use regex to get the cookie for cf_clearance=*;
-                    cf_clearance_cookie = re.search(
-                        "cf_clearance=.*?;",
-                        message["params"]["headers"]["set-cookie"],
-                    )
-                    puid_cookie = re.search(
-                        "_puid=.*?;",
-                        message["params"]["headers"]["set-cookie"],
-                    )
-                    session_cookie = re.search(
-                        "__Secure-next-auth.session-token=.*?;",
-                        message["params"]["headers"]["set-cookie"],
+        try:
+            set_cookie = message["params"]["headers"]["set-cookie"]
+        except (KeyError, TypeError):
+            return
+        for name, value in COOKIE_PATTERN.findall(set_cookie):
+            if name == "cf_clearance" and not self.cf_cookie_found.is_set():
+                print("Found Cloudflare Cookie!")
+                self.detected["cf_clearance"] = value
+                if self.verbose:
+                    print(
+                        self.GREEN + "Cloudflare Cookie: " + self.ENDCOLOR + value,
                     )
-                    if cf_clearance_cookie and not self.cf_cookie_found:
-                        print("Found Cloudflare Cookie!")
-                        # remove the semicolon and 'cf_clearance=' from the string
-                        raw_cf_cookie = cf_clearance_cookie.group(0)
-                        self.cf_clearance = raw_cf_cookie.split("=")[1][:-1]
-                        if self.verbose:
-                            print(
-                                self.GREEN
-                                + "Cloudflare Cookie: "
-                                + self.ENDCOLOR
-                                + self.cf_clearance,
-                            )
-                        self.cf_cookie_found = True
-                    if puid_cookie and not self.puid_cookie_found:
-                        raw_puid_cookie = puid_cookie.group(0)
-                        self.puid_cookie = raw_puid_cookie.split("=")[1][:-1]
-                        self.session.cookies.set(
-                            "_puid",
-                            self.puid_cookie,
-                        )
-                        if self.verbose:
-                            print(
-                                self.GREEN
-                                + "puid Cookie: "
-                                + self.ENDCOLOR
-                                + self.puid_cookie,
-                            )
-                        self.puid_cookie_found = True
-                    if session_cookie and not self.session_cookie_found:
-                        print("Found Session Token!")
-                        # remove the semicolon and '__Secure-next-auth.session-token=' from the string
-                        raw_session_cookie = session_cookie.group(0)
-                        self.session_token = raw_session_cookie.split("=")[1][:-1]
-                        self.session.cookies.set(
-                            "__Secure-next-auth.session-token",
-                            self.session_token,
-                        )
-                        if self.verbose:
-                            print(
-                                self.GREEN
-                                + "Session Token: "
-                                + self.ENDCOLOR
-                                + self.session_token,
-                            )
-                        self.session_cookie_found = True
+                self.cf_cookie_found.set()
+            elif name == "_puid" and not self.puid_cookie_found.is_set():
+                self.detected["puid_cookie"] = value
+                if self.verbose:
+                    print(self.GREEN + "puid Cookie: " + self.ENDCOLOR + value)
+                self.puid_cookie_found.set()
+            elif (
+                name == "__Secure-next-auth.session-token"
+                and not self.session_cookie_found.is_set()
+            ):
+                print("Found Session Token!")
+                self.detected["session_token"] = value
+                if self.verbose:
+                    print(self.GREEN + "Session Token: " + self.ENDCOLOR + value)
+                self.session_cookie_found.set()
 
     def __detect_user_agent(self, message):
-        if "params" in message:
-            if "headers" in message["params"]:
-                if "user-agent" in message["params"]["headers"]:
-                    # Use regex to get the cookie for cf_clearance=*;
-                    user_agent = message["params"]["headers"]["user-agent"]
-                    self.user_agent = user_agent
-                    self.agent_found = True
-        self.__refresh_headers(
-            cf_clearance=self.cf_clearance,
-            puid_cookie=self.puid_cookie,
-            user_agent=self.user_agent,
-        )
+        if self.agent_found.is_set():
+            return
+        try:
+            self.detected["user_agent"] = message["params"]["headers"]["user-agent"]
+        except (KeyError, TypeError):
+            return
+        self.agent_found.set()
+
+    def __swap_headers(self, headers, clear=False):
+        """
+        Replace the session headers in one assignment, so requests on other
+        threads see either the old or the new credentials
+        """
+        with self.credentials_lock:
+            new_headers = self.session.headers.copy()
+            if clear:
+                new_headers.clear()
+            new_headers.update(headers)
+            self.session.headers = new_headers
 
     def __refresh_headers(self, cf_clearance, puid_cookie, user_agent):
-        del self.session.cookies["cf_clearance"]
-        del self.session.cookies["_puid"]
-        self.session.headers.clear()
-        self.session.cookies.set("cf_clearance", cf_clearance)
-        self.session.cookies.set("_puid", puid_cookie)
-        self.session.headers.update(
-            {
-                "Accept": "text/event-stream",
-                "Authorization": "Bearer ",
-                "Content-Type": "application/json",
-                "User-Agent": user_agent,
-                "X-Openai-Assistant-App-Id": "",
-                "Connection": "close",
-                "Accept-Language": "en-US,en;q=0.9",
-                "Referer": "https://chat.openai.com/chat",
-            },
-        )
+        # Requests snapshot the credentials under the same lock, so none is
+        # sent with the new clearance and the old User-Agent
+        with self.credentials_lock:
+            self.session.cookies.set("cf_clearance", cf_clearance)
+            self.session.cookies.set("_puid", puid_cookie)
+            self.__swap_headers(
+                {
+                    "Accept": "text/event-stream",
+                    # Keep the access token, which a new clearance doesn't
+                    # invalidate
+                    "Authorization": self.session.headers.get(
+                        "Authorization",
+                        "Bearer ",
+                    ),
+                    "Content-Type": "application/json",
+                    "User-Agent": user_agent,
+                    "X-Openai-Assistant-App-Id": "",
+                    "Connection": "close",
+                    "Accept-Language": "en-US,en;q=0.9",
+                    "Referer": "https://chat.openai.com/chat",
+                },
+                clear=True,
+            )
 
     def rollback_conversation(self, num=1) -> None:
         """
@@ -738,6 +1309,206 @@ class Chatbot:
             self.parent_id = self.parent_id_prev_queue.pop()
 
 
+class AsyncChatbot:
+    """
+    Asyncio interface to Chatbot
+
+    tls_client only offers blocking calls, so they run on a bounded thread pool
+    and at most max_workers requests are in flight at once.
+
+    Turns of one conversation are serialised, so each continues from the
+    reply of the previous one; different conversations run concurrently.
+    Calls without a conversation_id continue the chatbot's current
+    conversation, which is the one that last received a reply, and run
+    one at a time with respect to each other.
+    """
+
+    def __init__(self, chatbot, max_workers=8) -> None:
+        self.chatbot = chatbot
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="revChatGPT",
+        )
+        # Per conversation, None for calls without a conversation_id
+        self.locks = WeakValueDictionary()
+
+    @property
+    def tracer(self) -> Tracer:
+        return self.chatbot.tracer
+
+    @classmethod
+    async def create(
+        cls,
+        config,
+        conversation_id=None,
+        parent_id=None,
+        max_workers=8,
+        tracer=None,
+    ):
+        """
+        Create a client, logging in without blocking the event loop
+        """
+        self = cls(None, max_workers=max_workers)
+        self.chatbot = await self.__run(
+            Chatbot,
+            config,
+            conversation_id=conversation_id,
+            parent_id=parent_id,
+            tracer=tracer,
+        )
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def __lock(self, conversation_id) -> asyncio.Lock:
+        lock = self.locks.get(conversation_id)
+        if lock is None:
+            lock = self.locks[conversation_id] = asyncio.Lock()
+        return lock
+
+    @asynccontextmanager
+    async def __turn(self, conversation_id):
+        """
+        Hold a conversation for one turn, yielding its ID or None for a new one
+        """
+        if conversation_id is not None:
+            async with self.__lock(conversation_id):
+                yield conversation_id
+            return
+        async with self.__lock(None):
+            current = self.chatbot.conversation_id
+            if current is None:
+                # Another call may start a conversation meanwhile, so ask for a
+                # new one explicitly rather than leaving it to the chatbot
+                yield None
+                return
+            async with self.__lock(current):
+                yield current
+
+    async def __run(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            partial(func, *args, **kwargs),
+        )
+
+    async def ask_stream(
+        self,
+        prompt,
+        conversation_id=None,
+        parent_id=None,
+        session_token=None,
+    ):
+        """
+        Ask a question to the chatbot, yielding the response as it is parsed
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        async with self.__turn(conversation_id) as conversation_id:
+
+            def produce():
+                try:
+                    for event in self.chatbot.ask_stream(
+                        prompt,
+                        conversation_id=conversation_id,
+                        parent_id=parent_id,
+                        session_token=session_token,
+                        new_conversation=conversation_id is None,
+                    ):
+                        loop.call_soon_threadsafe(queue.put_nowait, ("event", event))
+                except Exception as exc:
+                    loop.call_soon_threadsafe(queue.put_nowait, ("error", exc))
+                finally:
+                    loop.call_soon_threadsafe(queue.put_nowait, ("done", None))
+
+            future = loop.run_in_executor(self.executor, produce)
+            try:
+                while True:
+                    kind, value = await queue.get()
+                    if kind == "done":
+                        break
+                    if kind == "error":
+                        raise value
+                    yield value
+            finally:
+                await future
+
+    async def ask(
+        self,
+        prompt,
+        conversation_id=None,
+        parent_id=None,
+        gen_title=False,
+        session_token=None,
+    ):
+        """
+        Ask a question to the chatbot
+        """
+        async with self.__turn(conversation_id) as conversation_id:
+            return await self.__run(
+                self.chatbot.ask,
+                prompt,
+                conversation_id=conversation_id,
+                parent_id=parent_id,
+                gen_title=gen_title,
+                session_token=session_token,
+                new_conversation=conversation_id is None,
+            )
+
+    async def get_conversations(self, offset=0, limit=20):
+        """
+        Get conversations
+        """
+        return await self.__run(self.chatbot.get_conversations, offset, limit)
+
+    async def get_msg_history(self, id):
+        """
+        Get message history
+        """
+        return await self.__run(self.chatbot.get_msg_history, id)
+
+    async def change_title(self, id, title):
+        """
+        Change title of conversation
+        """
+        await self.__run(self.chatbot.change_title, id, title)
+
+    async def delete_conversation(self, id):
+        """
+        Delete conversation
+        """
+        await self.__run(self.chatbot.delete_conversation, id)
+
+    async def clear_conversations(self):
+        """
+        Delete all conversations
+        """
+        await self.__run(self.chatbot.clear_conversations)
+
+    def reset_chat(self) -> None:
+        """
+        Reset the conversation ID and parent ID.
+        """
+        self.chatbot.reset_chat()
+
+    def rollback_conversation(self, num=1) -> None:
+        """
+        Rollback the conversation.
+        """
+        self.chatbot.rollback_conversation(num)
+
+    async def close(self):
+        """
+        Stop background work, quit the warm browser and release the thread pool
+        """
+        if self.chatbot is not None:
+            self.chatbot.close()
+        self.executor.shutdown(wait=False)
+
+
 def get_input(prompt):
     # Display the prompt
     print(prompt, end="")
@@ -785,12 +1556,13 @@ def configure():
 def chatGPT_main(config):
     print("Logging in...")
     chatbot = Chatbot(config)
-    while True:
-        prompt = get_input("\nYou:\n")
-        if prompt.startswith("!"):
-            if prompt == "!help":
-                print(
-                    """
+    try:
+        while True:
+            prompt = get_input("\nYou:\n")
+            if prompt.startswith("!"):
+                if prompt == "!help":
+                    print(
+                        """
                 !help - Show this message
                 !reset - Forget the current conversation
                 !refresh - Refresh the session authentication
@@ -798,52 +1570,59 @@ def chatGPT_main(config):
                 !rollback x - Rollback the conversation (x being the number of messages to rollback)
                 !exit - Exit this program
                 """,
-                )
-                continue
-            elif prompt == "!reset":
-                chatbot.reset_chat()
-                print("Chat session successfully reset.")
-                continue
-            elif prompt == "!refresh":
-                chatbot.__refresh_session()
-                print("Session successfully refreshed.\n")
-                continue
-            elif prompt == "!config":
-                print(json.dumps(chatbot.config, indent=4))
-                continue
-            elif prompt.startswith("!rollback"):
-                # Default to 1 rollback if no number is specified
-                try:
-                    rollback = int(prompt.split(" ")[1])
-                except IndexError:
-                    rollback = 1
-                chatbot.rollback_conversation(rollback)
-                print(f"Rolled back {rollback} messages.")
-                continue
-            elif prompt.startswith("!setconversation"):
-                try:
-                    chatbot.config["conversation"] = prompt.split(" ")[1]
-                    print("Conversation has been changed")
-                except IndexError:
-                    print("Please include conversation UUID in command")
+                    )
+                    continue
+                elif prompt == "!reset":
+                    chatbot.reset_chat()
+                    print("Chat session successfully reset.")
+                    continue
+                elif prompt == "!refresh":
+                    chatbot.__refresh_session()
+                    print("Session successfully refreshed.\n")
+                    continue
+                elif prompt == "!config":
+                    print(json.dumps(chatbot.config, indent=4))
+                    continue
+                elif prompt.startswith("!rollback"):
+                    # Default to 1 rollback if no number is specified
+                    try:
+                        rollback = int(prompt.split(" ")[1])
+                    except IndexError:
+                        rollback = 1
+                    chatbot.rollback_conversation(rollback)
+                    print(f"Rolled back {rollback} messages.")
+                    continue
+                elif prompt.startswith("!setconversation"):
+                    try:
+                        chatbot.config["conversation"] = prompt.split(" ")[1]
+                        print("Conversation has been changed")
+                    except IndexError:
+                        print("Please include conversation UUID in command")
+                    continue
+                elif prompt == "!exit":
+                    break
+            try:
+                print("Chatbot: ")
+                prev_text = ""
+                for data in chatbot.ask_stream(
+                    prompt,
+                    conversation_id=chatbot.config.get("conversation"),
+                    parent_id=chatbot.config.get("parent_id"),
+                ):
+                    print(data["message"][len(prev_text) :], end="", flush=True)
+                    prev_text = data["message"]
+                print()
+            except Exception as exc:
+                print("Something went wrong!")
+                print(exc)
                 continue
-            elif prompt == "!exit":
-                break
-        try:
-            print("Chatbot: ")
-            message = chatbot.ask(
-                prompt,
-                conversation_id=chatbot.config.get("conversation"),
-                parent_id=chatbot.config.get("parent_id"),
-            )
-            print(message["message"])
-        except Exception as exc:
-            print("Something went wrong!")
-            print(exc)
-            continue
+    finally:
+        chatbot.close()
 
 
 def main():
+    # Keep the browser automation libraries quiet on the command line
+    logging.basicConfig(level=logging.ERROR)
     print(
         """
         ChatGPT - A command-line interface to OpenAI's ChatGPT (https://chat.openai.com/chat)
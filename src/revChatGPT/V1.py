@@ -2,29 +2,36 @@
 Standard ChatGPT
 """
 import logging
-logging.basicConfig(filename="chatbot.log", format="%(asctime)s - %(name)s - %(levelname)s - %(funcName)s - %(message)s")
 def logger(is_timed):
     def decorator(func):
         from functools import wraps
         import time
-        wraps(func)
+        log = logging.getLogger(f"{func.__module__}.{func.__qualname__}")
+        @wraps(func)
         def wrapper(*args, **kwargs):
-            log = logging.getLogger(func.__name__)
-            log.info(f'Entering {func.__name__} with args {args} and kwargs {kwargs}')
+            # Skip formatting the arguments and timing unless it will be logged
+            if not log.isEnabledFor(logging.INFO):
+                return func(*args, **kwargs)
+            log.info("Entering %s with args %s and kwargs %s", func.__name__, args, kwargs)
             start = time.time()
             out = func(*args, **kwargs)
             end = time.time()
             if is_timed:
-                log.info(f"Exiting {func.__name__} with return value {out}. Took {end - start} seconds.")
+                log.info("Exiting %s with return value %s. Took %s seconds.", func.__name__, out, end - start)
             else:
-                log.info(f"Exiting {func.__name__} with return value {out}")
+                log.info("Exiting %s with return value %s", func.__name__, out)
             # Return the return value
             return out
         return wrapper
     return decorator
 log = logging.getLogger(__name__)
+import argparse
 import json
+import threading
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from os import environ
 from os import getenv
 from os.path import exists
@@ -34,15 +41,21 @@ from colorama import Fore, Back, Style, init
 import requests
 from OpenAIAuth import Authenticator, Error as AuthError
 
-BASE_URL = environ.get("CHATGPT_BASE_URL") or "https://chatgpt.duti.tech/"
-
-
-class Error(Exception):
-    """Base class for exceptions in this module."""
+if __package__:
+    from .logs import start_logging
+    from .tracing import Tracer
+    from .transport import check_response
+    from .transport import Error
+    from .transport import RequestsTransport
+else:
+    # Run as a script, e.g. python src/revChatGPT/V1.py
+    from logs import start_logging
+    from tracing import Tracer
+    from transport import check_response
+    from transport import Error
+    from transport import RequestsTransport
 
-    source: str
-    message: str
-    code: int
+BASE_URL = environ.get("CHATGPT_BASE_URL") or "https://chatgpt.duti.tech/"
 
 
 class Chatbot:
@@ -56,17 +69,19 @@ class Chatbot:
         config,
         conversation_id=None,
         parent_id=None,
+        tracer=None,
     ) -> None:
         self.config = config
-        self.session = requests.Session()
         if "proxy" in config:
             if isinstance(config["proxy"], str) is False:
                 raise Exception("Proxy must be a string!")
-            proxies = {
-                "http": config["proxy"],
-                "https": config["proxy"],
-            }
-            self.session.proxies.update(proxies)
+        # Hooks registered on the tracer receive timed spans and events
+        self.tracer = tracer or Tracer()
+        self.transport = RequestsTransport(
+            proxy=config.get("proxy"),
+            tracer=self.tracer,
+        )
+        self.session = self.transport.session
         self.conversation_id = conversation_id
         self.parent_id = parent_id
         self.conversation_mapping = {}
@@ -83,12 +98,14 @@ class Chatbot:
             raise Exception("No login details provided!")
         if "access_token" not in config:
             try:
-                self.__login()
+                with self.tracer.span("auth_refresh"):
+                    self.__login()
             except AuthError as error:
                 raise error
 
     @logger(is_timed=False)
     def __refresh_headers(self, access_token):
+        self.access_token = access_token
         self.session.headers.clear()
         self.session.headers.update(
             {
@@ -166,16 +183,20 @@ class Chatbot:
         if conversation_id is None and parent_id is None:  # new conversation
             parent_id = str(uuid.uuid4())
             gen_title = True
-            log.debug(f"New conversation, setting parent_id to new UUID4: {parent_id}")
+            log.debug("New conversation, setting parent_id to new UUID4: %s", parent_id)
 
         if conversation_id is not None and parent_id is None:
             if conversation_id not in self.conversation_mapping:
                 log.debug(
-                    f"Conversation ID {conversation_id} not found in conversation mapping, mapping conversations",
+                    "Conversation ID %s not found in conversation mapping, mapping conversations",
+                    conversation_id,
                 )
-                self.__map_conversations()
+                with self.tracer.span("mapping", conversation_id=conversation_id):
+                    self.__map_conversations()
             log.debug(
-                f"Conversation ID {conversation_id} found in conversation mapping, setting parent_id to {self.conversation_mapping[conversation_id]}",
+                "Conversation ID %s found in conversation mapping, setting parent_id to %s",
+                conversation_id,
+                self.conversation_mapping[conversation_id],
             )
             parent_id = self.conversation_mapping[conversation_id]
         data = {
@@ -193,25 +214,30 @@ class Chatbot:
             if not self.config.get("paid")
             else "text-davinci-002-render-paid",
         }
-        log.debug(f"Sending the payload:")
-        log.debug(json.dumps(data, indent=2))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Sending the payload:\n%s", json.dumps(data, indent=2))
         # new_conv = data["conversation_id"] is None
         self.conversation_id_prev_queue.append(
             data["conversation_id"],
         )  # for rollback
         self.parent_id_prev_queue.append(data["parent_message_id"])
-        response = self.session.post(
-            url=BASE_URL + "api/conversation",
+        response = self.transport.post(
+            BASE_URL + "api/conversation",
             data=json.dumps(data),
             timeout=timeout,
             stream=True,
         )
-        self.__check_response(response)
+        check_response(response)
         if self.encoding != None:
           response.encoding = self.encoding
         else:
           response.encoding = response.apparent_encoding
+        first_byte = bool(self.tracer)
+        events = 0
         for line in response.iter_lines():
+            if first_byte:
+                first_byte = False
+                self.tracer.event("first_byte")
             line = str(line)[2:-1]
             if line == "Internal Server Error":
                 log.error(f"Internal Server Error: {line}")
@@ -240,21 +266,26 @@ class Chatbot:
             message = line["message"]["content"]["parts"][0]
             conversation_id = line["conversation_id"]
             parent_id = line["message"]["id"]
-            log.debug(f"Received message: {message}")
-            log.debug(f"Received conversation_id: {conversation_id}")
-            log.debug(f"Received parent_id: {parent_id}")
+            events += 1
+            if self.tracer:
+                self.tracer.event("event", index=events, length=len(message))
+            log.debug("Received message: %s", message)
+            log.debug("Received conversation_id: %s", conversation_id)
+            log.debug("Received parent_id: %s", parent_id)
             yield {
                 "message": message,
                 "conversation_id": conversation_id,
                 "parent_id": parent_id,
             }
+        self.tracer.event("stream_end", events=events)
         self.conversation_mapping[conversation_id] = parent_id
         if parent_id is not None:
             self.parent_id = parent_id
         if conversation_id is not None:
             self.conversation_id = conversation_id
         if gen_title:
-            self.gen_title(conversation_id, parent_id)
+            with self.tracer.span("gen_title", conversation_id=conversation_id):
+                self.gen_title(conversation_id, parent_id)
 
     @logger(is_timed=False)
     def __check_fields(self, data: dict) -> bool:
@@ -266,17 +297,6 @@ class Chatbot:
             return False
         return True
 
-    @logger(is_timed=False)
-    def __check_response(self, response):
-        response.encoding = response.apparent_encoding
-        if response.status_code != 200:
-            print(response.text)
-            error = Error()
-            error.source = "OpenAI"
-            error.code = response.status_code
-            error.message = response.text
-            raise error
-
     @logger(is_timed=True)
     def get_conversations(self, offset=0, limit=20):
         """
@@ -285,12 +305,12 @@ class Chatbot:
         :param limit: Integer
         """
         url = BASE_URL + f"api/conversations?offset={offset}&limit={limit}"
-        response = self.session.get(url)
+        response = self.transport.get(url)
         if self.encoding != None:
           response.encoding = self.encoding
         else:
           response.encoding = response.apparent_encoding
-        self.__check_response(response)
+        check_response(response)
         data = json.loads(response.text)
         return data["items"]
 
@@ -301,12 +321,12 @@ class Chatbot:
         :param id: UUID of conversation
         """
         url = BASE_URL + f"api/conversation/{convo_id}"
-        response = self.session.get(url)
+        response = self.transport.get(url)
         if self.encoding != None:
           response.encoding = self.encoding
         else:
           response.encoding = response.apparent_encoding
-        self.__check_response(response)
+        check_response(response)
         data = json.loads(response.text)
         return data
 
@@ -316,13 +336,13 @@ class Chatbot:
         Generate title for conversation
         """
         url = BASE_URL + f"api/conversation/gen_title/{convo_id}"
-        response = self.session.post(
+        response = self.transport.post(
             url,
             data=json.dumps(
                 {"message_id": message_id, "model": "text-davinci-002-render"},
             ),
         )
-        self.__check_response(response)
+        check_response(response)
 
     @logger(is_timed=True)
     def change_title(self, convo_id, title):
@@ -332,8 +352,8 @@ class Chatbot:
         :param title: String
         """
         url = BASE_URL + f"api/conversation/{convo_id}"
-        response = self.session.patch(url, data=json.dumps({"title": title}))
-        self.__check_response(response)
+        response = self.transport.patch(url, data=json.dumps({"title": title}))
+        check_response(response)
 
     @logger(is_timed=True)
     def delete_conversation(self, convo_id):
@@ -342,8 +362,8 @@ class Chatbot:
         :param id: UUID of conversation
         """
         url = BASE_URL + f"api/conversation/{convo_id}"
-        response = self.session.patch(url, data='{"is_visible": false}')
-        self.__check_response(response)
+        response = self.transport.patch(url, data='{"is_visible": false}')
+        check_response(response)
         self.conversation_id = None
         self.parent_id = None
 
@@ -353,8 +373,8 @@ class Chatbot:
         Delete all conversations
         """
         url = BASE_URL + "api/conversations"
-        response = self.session.patch(url, data='{"is_visible": false}')
-        self.__check_response(response)
+        response = self.transport.patch(url, data='{"is_visible": false}')
+        check_response(response)
 
     @logger(is_timed=False)
     def __map_conversations(self):
@@ -373,7 +393,7 @@ class Chatbot:
         self.conversation_id = None
         self.parent_id = str(uuid.uuid4())
 
-    @logger
+    @logger(is_timed=False)
     def rollback_conversation(self, num=1) -> None:
         """
         Rollback the conversation.
@@ -580,7 +600,269 @@ Commands:
         # print(message["message"])
 
 
+def read_batch(file):
+    """
+    Read batch prompts, either plain text with one prompt per line or JSONL
+    objects with a "prompt" and optional "conversation_id". Lines that look
+    like JSON but are not a valid prompt object come with an "error".
+    """
+    for line_number, line in enumerate(file):
+        line = line.rstrip("\n")
+        if not line.strip():
+            continue
+        if line.lstrip().startswith("{"):
+            try:
+                item = json.loads(line)
+                if not isinstance(item, dict) or "prompt" not in item:
+                    raise ValueError('Expected an object with a "prompt"')
+            except ValueError as exc:
+                item = {"error": f"Invalid JSON line: {exc}"}
+        else:
+            item = {"prompt": line}
+        item["line"] = line_number
+        yield item
+
+
+def read_answered(path):
+    """
+    Get the answers already written to a batch output file, by line
+    """
+    answered = {}
+    if not exists(path):
+        return answered
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                # Partially written line of an interrupted run
+                continue
+            if "message" in record:
+                answered[record["line"]] = record
+    return answered
+
+
+def is_uuid(value) -> bool:
+    try:
+        uuid.UUID(str(value))
+    except ValueError:
+        return False
+    return True
+
+
+@logger(is_timed=True)
+def batch(config, source, output, stream=False, parallel=1, answered=None):
+    """
+    Answer prompts from a file, writing JSONL records to output.
+
+    Lines sharing a conversation_id are asked in order in one conversation,
+    which continues an existing conversation if the id is a ChatGPT
+    conversation UUID. Other lines each start a new conversation. Up to
+    parallel conversations run at once, with one Chatbot per worker thread.
+    Lines are dispatched as they are read, so answers start before the input
+    ends and only a few lines per worker are held in memory.
+    :param answered: Records of lines to skip, by line, as from read_answered
+    """
+    answered = answered or {}
+    lock = threading.Lock()
+    local = threading.local()
+    # Lines waiting for the worker that runs their conversation, by group
+    queues = {}
+    # Where each conversation with a conversation_id got to, by group
+    positions = {}
+    # Bounds how far reading runs ahead of the answers
+    slots = threading.Semaphore(2 * parallel)
+    chatbots = []
+    # Config of the workers after the first, which log in with its access token
+    worker_config = None
+    pending = set()
+    failures = []
+    executor = ThreadPoolExecutor(max_workers=parallel)
+
+    def write(record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with lock:
+            output.write(line)
+            output.flush()
+
+    def answer(chatbot, item, key):
+        if item["line"] in answered:
+            # Continue after the answers of an earlier run
+            chatbot.conversation_id = answered[item["line"]]["conversation_id"]
+            chatbot.parent_id = answered[item["line"]]["parent_id"]
+            return
+        record = {"line": item["line"]}
+        if "id" in item:
+            record["id"] = item["id"]
+        if key is not None:
+            record["conversation"] = key
+        try:
+            message = ""
+            for data in chatbot.ask(item["prompt"]):
+                if stream and len(data["message"]) > len(message):
+                    write(dict(record, delta=data["message"][len(message) :]))
+                message = data["message"]
+            write(
+                dict(
+                    record,
+                    message=message,
+                    conversation_id=chatbot.conversation_id,
+                    parent_id=chatbot.parent_id,
+                ),
+            )
+        except Exception as exc:
+            log.exception("Batch line %s failed", item["line"])
+            write(dict(record, error=str(exc)))
+
+    def run(group, key):
+        if not hasattr(local, "chatbot"):
+            with lock:
+                chatbot = chatbots.pop() if chatbots else None
+            # Reuse the access token of the first login instead of logging in again
+            local.chatbot = chatbot or Chatbot(worker_config)
+        chatbot = local.chatbot
+        chatbot.reset_chat()
+        with lock:
+            position = positions.get(group)
+        if position is not None:
+            chatbot.conversation_id, chatbot.parent_id = position
+        elif key is not None and is_uuid(key):
+            chatbot.conversation_id = key
+            chatbot.parent_id = None
+        while not failures:
+            with lock:
+                if not queues[group]:
+                    del queues[group]
+                    if key is not None:
+                        positions[group] = (chatbot.conversation_id, chatbot.parent_id)
+                    return
+                item = queues[group].popleft()
+            try:
+                answer(chatbot, item, key)
+            finally:
+                slots.release()
+
+    def done(future):
+        with lock:
+            pending.discard(future)
+            if not future.cancelled() and future.exception() is not None:
+                failures.append(future.exception())
+
+    try:
+        for item in read_batch(source):
+            if "error" in item:
+                write({"line": item["line"], "error": item["error"]})
+                continue
+            key = item.get("conversation_id")
+            # Separate namespaces, so an id such as 0 never joins line 0's group
+            if key is None:
+                group = ("line", item["line"])
+            else:
+                group = ("conversation", json.dumps(key, sort_keys=True))
+            if worker_config is None:
+                # Log in before starting, so bad credentials fail once and fast
+                chatbot = Chatbot(dict(config))
+                worker_config = {
+                    name: value
+                    for name, value in config.items()
+                    if name not in ("email", "password", "session_token")
+                }
+                worker_config["access_token"] = chatbot.access_token
+                chatbots.append(chatbot)
+            while not slots.acquire(timeout=1):
+                if failures:
+                    break
+            if failures:
+                # Raise the first failure to start a worker, such as a login error
+                raise failures[0]
+            with lock:
+                if group in queues:
+                    queues[group].append(item)
+                    continue
+                queues[group] = deque([item])
+                future = executor.submit(run, group, key)
+                pending.add(future)
+            future.add_done_callback(done)
+        while True:
+            with lock:
+                remaining = list(pending)
+            if not remaining:
+                break
+            wait(remaining)
+        if failures:
+            raise failures[0]
+    finally:
+        # After a failure, drop the conversations that have not started
+        with lock:
+            remaining = list(pending)
+        for future in remaining:
+            future.cancel()
+        executor.shutdown()
+
+
+def batch_main(config, args):
+    """
+    Run batch mode from command line arguments
+    """
+    if args.resume and args.output is None:
+        raise Exception("--resume requires --output")
+    answered = read_answered(args.output) if args.resume else {}
+    source = sys.stdin if args.batch == "-" else open(args.batch, encoding="utf-8")
+    output = (
+        sys.stdout
+        if args.output is None
+        else open(args.output, "a" if args.resume else "w", encoding="utf-8")
+    )
+    try:
+        batch(
+            config,
+            source,
+            output,
+            stream=args.stream,
+            parallel=args.parallel,
+            answered=answered,
+        )
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+
+
 if __name__ == "__main__":
+    # The command line keeps a log file, written from a background thread
+    start_logging("chatbot.log", level=logging.WARNING, logger=None)
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--batch",
+        help="Answer prompts from a file (- for stdin), plain text or JSONL, instead of chatting",
+        required=False,
+    )
+    parser.add_argument(
+        "--output",
+        help="Write batch answers to this JSONL file instead of stdout",
+        required=False,
+    )
+    parser.add_argument(
+        "--stream",
+        help="Write partial answers as they arrive in batch mode",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--parallel",
+        help="Number of conversations answered at once in batch mode",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--resume",
+        help="Skip lines already answered in --output",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    if args.batch is not None:
+        batch_main(configure(), args)
+        sys.exit(0)
     init()
     print(
 f"""
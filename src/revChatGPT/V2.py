@@ -1,24 +1,108 @@
 """
 Official API for ChatGPT
 """
+from __future__ import annotations
+
 import asyncio
+import gzip
 import json
 import os
+import sqlite3
+import struct
 import sys
+import time
+from bisect import bisect_right
+from collections import deque
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import Executor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from itertools import accumulate
+from threading import Lock
+from threading import RLock
+from typing import BinaryIO
+from typing import Iterable
+from typing import Iterator
+from weakref import WeakValueDictionary
 
 import httpx
 import requests
 import tiktoken
 from OpenAIAuth.OpenAIAuth import OpenAIAuth
 
-ENCODER = tiktoken.get_encoding("gpt2")
+if __package__:
+    from .tracing import Tracer
+    from .transport import check_response
+    from .transport import HTTPXTransport
+else:
+    # Run as a script, e.g. python src/revChatGPT/V2.py
+    from tracing import Tracer
+    from transport import check_response
+    from transport import HTTPXTransport
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
-def get_max_tokens(prompt: str) -> int:
+class Tokenizer:
     """
-    Get the max tokens for a prompt
+    Counts tokens, memoising repeated strings and encoding off the event loop
     """
-    return 4000 - len(ENCODER.encode(prompt))
+
+    def __init__(
+        self,
+        encoding: str = "gpt2",
+        executor: Executor = None,
+        cache_size: int = 1024,
+    ) -> None:
+        self.encoding = tiktoken.get_encoding(encoding)
+        # None uses the event loop's default thread pool
+        self.executor: Executor = executor
+        self.cache_size: int = cache_size
+        self.cache: OrderedDict[str, int] = OrderedDict()
+        self.cache_lock = Lock()
+
+    def __lookup(self, text: str) -> int:
+        with self.cache_lock:
+            count = self.cache.get(text)
+            if count is not None:
+                self.cache.move_to_end(text)
+            return count
+
+    def __store(self, text: str, count: int) -> None:
+        with self.cache_lock:
+            self.cache[text] = count
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def count(self, text: str) -> int:
+        """
+        Counts the tokens in a string
+        """
+        count = self.__lookup(text)
+        if count is None:
+            count = len(self.encoding.encode(text))
+            self.__store(text, count)
+        return count
+
+    async def acount(self, text: str) -> int:
+        """
+        Counts the tokens in a string without blocking the event loop
+        """
+        count = self.__lookup(text)
+        if count is not None:
+            return count
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            self.count,
+            text,
+        )
+
+
+TOKENIZER = Tokenizer()
 
 
 class Message:
@@ -26,9 +110,29 @@ class Message:
     A single exchange between the user and the bot
     """
 
-    def __init__(self, text: str, author: str) -> None:
+    # Messages are kept by the million, so avoid a per-instance __dict__
+    __slots__ = ("text", "author", "tokens")
+
+    def __init__(self, text: str, author: str, tokens: int = None) -> None:
         self.text: str = text
-        self.author: str = author
+        # There are only a few distinct authors, so share one string per author
+        self.author: str = sys.intern(author)
+        # Token count of the rendered message. Left unset until the message is
+        # added, so it is counted once with the tokenizer of its owner
+        self.tokens: int = tokens
+
+    @staticmethod
+    def format(text: str, author: str) -> str:
+        """
+        Formats a message as it appears in the prompt
+        """
+        return f"{author}: {text}<|im_sep|>\n\n"
+
+    def render(self) -> str:
+        """
+        Renders the message as it appears in the prompt
+        """
+        return self.format(self.text, self.author)
 
 
 class Conversation:
@@ -36,28 +140,404 @@ class Conversation:
     A single conversation
     """
 
+    __slots__ = ("messages", "tokens")
+
     def __init__(self) -> None:
         self.messages: list[Message] = []
+        # Running total of the token counts of all messages
+        self.tokens: int = 0
+
+    def append(self, message: Message) -> None:
+        """
+        Adds a message to the end of the conversation
+        """
+        if message.tokens is None:
+            message.tokens = TOKENIZER.count(message.render())
+        self.messages.append(message)
+        self.tokens += message.tokens
+
+    def purge(self, num: int = 1) -> None:
+        """
+        Remove oldest messages
+        """
+        self.trim(0, num)
+
+    def rollback(self, num: int = 1) -> None:
+        """
+        Remove latest messages
+        """
+        messages = self.messages[:-num]
+        self.tokens -= sum(message.tokens for message in self.messages[len(messages) :])
+        self.messages = messages
+
+    def trim(self, head: int, start: int) -> None:
+        """
+        Remove the messages between the first head messages and start
+        """
+        if start <= head:
+            return
+        self.tokens -= sum(message.tokens for message in self.messages[head:start])
+        del self.messages[head:start]
+
+    def render(self) -> str:
+        """
+        Builds the conversation string
+        """
+        return "".join([message.render() for message in self.messages])
+
+
+def _tail_start(tokens: list[int], budget: int) -> int:
+    """
+    Index of the oldest message of the longest tail that fits in the budget
+    """
+    # Suffix sums are increasing, so the cut point can be found by bisection
+    suffix_sums = list(accumulate(reversed(tokens)))
+    return len(tokens) - bisect_right(suffix_sums, budget)
+
+
+def sliding_window(tokens: list[int], budget: int) -> tuple[int, int]:
+    """
+    Trimming strategy that keeps the newest messages that fit in the budget
+
+    Strategies take the token count of every message and the token budget, and
+    return (head, start): messages[:head] and messages[start:] are kept
+    """
+    return 0, _tail_start(tokens, budget)
+
+
+def keep_first(num: int):
+    """
+    Trimming strategy that keeps the first num messages plus the newest
+    messages that fit in the remaining budget
+    """
+
+    def strategy(tokens: list[int], budget: int) -> tuple[int, int]:
+        prefix_sums = list(accumulate(tokens[:num]))
+        head = bisect_right(prefix_sums, budget)
+        remaining = budget - (prefix_sums[head - 1] if head else 0)
+        return head, head + _tail_start(tokens[head:], remaining)
+
+    return strategy
 
 
 CONVERSATION_BUFFER: int = int(os.environ.get("CONVERSATION_BUFFER") or 1500)
 
+BASE_PROMPT = (
+    os.environ.get("BASE_PROMPT")
+    or """You are ChatGPT, a large language model by OpenAI. Respond conversationally\n\n\n"""
+)
+
+
+class ConversationStore(MutableMapping):
+    """
+    Conversation storage that keeps recently used conversations in memory and
+    spills the least recently used ones to SQLite
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_conversations: int = 1000,
+        max_bytes: int = None,
+    ) -> None:
+        self.max_conversations: int = max_conversations
+        self.max_bytes: int = max_bytes
+        self.hot: OrderedDict[str, Conversation] = OrderedDict()
+        # Approximate size of each hot conversation, measured on access
+        self.sizes: dict[str, int] = {}
+        # Running total of sizes, so eviction does not sum them on every access
+        self.bytes: int = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS conversations "
+            "(id TEXT PRIMARY KEY, messages TEXT NOT NULL)",
+        )
+
+    @staticmethod
+    def _encode(conversation: Conversation) -> str:
+        return json.dumps(
+            [
+                [message.author, message.text, message.tokens]
+                for message in conversation.messages
+            ],
+        )
+
+    @staticmethod
+    def _decode(data: str) -> Conversation:
+        conversation = Conversation()
+        for author, text, tokens in json.loads(data):
+            conversation.append(Message(text, author, tokens))
+        return conversation
+
+    @staticmethod
+    def _size(conversation: Conversation) -> int:
+        return sum(len(message.text) for message in conversation.messages)
+
+    def _touch(self, conversation_id: str, conversation: Conversation) -> None:
+        self.hot[conversation_id] = conversation
+        self.hot.move_to_end(conversation_id)
+        size = self._size(conversation)
+        self.bytes += size - self.sizes.get(conversation_id, 0)
+        self.sizes[conversation_id] = size
+        self._evict()
+
+    def _evict(self) -> None:
+        while len(self.hot) > 1 and (
+            (self.max_conversations and len(self.hot) > self.max_conversations)
+            or (self.max_bytes and self.bytes > self.max_bytes)
+        ):
+            conversation_id, conversation = self.hot.popitem(last=False)
+            self.bytes -= self.sizes.pop(conversation_id)
+            self._spill(conversation_id, conversation)
+
+    def _spill(self, conversation_id: str, conversation: Conversation) -> None:
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO conversations VALUES (?, ?)",
+                (conversation_id, self._encode(conversation)),
+            )
+
+    def __getitem__(self, conversation_id: str) -> Conversation:
+        if conversation_id in self.hot:
+            conversation = self.hot[conversation_id]
+        else:
+            row = self.db.execute(
+                "SELECT messages FROM conversations WHERE id = ?",
+                (conversation_id,),
+            ).fetchone()
+            if row is None:
+                raise KeyError(conversation_id)
+            conversation = self._decode(row[0])
+        self._touch(conversation_id, conversation)
+        return conversation
+
+    def __setitem__(self, conversation_id: str, conversation: Conversation) -> None:
+        self._touch(conversation_id, conversation)
+
+    def __delitem__(self, conversation_id: str) -> None:
+        found = self.hot.pop(conversation_id, None) is not None
+        self.bytes -= self.sizes.pop(conversation_id, 0)
+        with self.db:
+            cursor = self.db.execute(
+                "DELETE FROM conversations WHERE id = ?",
+                (conversation_id,),
+            )
+        if not found and cursor.rowcount == 0:
+            raise KeyError(conversation_id)
+
+    def __contains__(self, conversation_id) -> bool:
+        if conversation_id in self.hot:
+            return True
+        return (
+            self.db.execute(
+                "SELECT 1 FROM conversations WHERE id = ?",
+                (conversation_id,),
+            ).fetchone()
+            is not None
+        )
+
+    def __iter__(self):
+        yield from list(self.hot)
+        for (conversation_id,) in self.db.execute("SELECT id FROM conversations"):
+            if conversation_id not in self.hot:
+                yield conversation_id
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def scan(self) -> Iterator[tuple[str, Conversation]]:
+        """
+        Iterates over all conversations without reloading spilled ones into
+        memory or changing which conversations are recently used
+        """
+        hot = list(self.hot.items())
+        yield from hot
+        # A spilled row is stale while its conversation is held in memory
+        held = {conversation_id for conversation_id, _ in hot}
+        for conversation_id, data in self.db.execute(
+            "SELECT id, messages FROM conversations",
+        ):
+            if conversation_id not in held:
+                yield conversation_id, self._decode(data)
+
+    def flush(self) -> None:
+        """
+        Writes every conversation held in memory to disk
+        """
+        for conversation_id, conversation in self.hot.items():
+            self._spill(conversation_id, conversation)
+
+    def close(self) -> None:
+        """
+        Flushes and closes the database
+        """
+        self.flush()
+        self.db.close()
+
+
+# Binary export format: magic, format version and compression, followed by the
+# compressed records. Each conversation is its length-prefixed id and message
+# count, then per message the author length, token count, text length, author
+# and text.
+DUMP_MAGIC = b"RCV2"
+DUMP_VERSION = 1
+_CONVERSATION_HEADER = struct.Struct("<II")
+_MESSAGE_HEADER = struct.Struct("<HII")
+
+
+def _read_exactly(stream: BinaryIO, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise ValueError("Truncated conversation dump")
+        data += chunk
+    return data
+
+
+def dump_conversations(
+    conversations: Iterable[tuple[str, Conversation]],
+    fp: BinaryIO,
+    compression: str = "gzip",
+) -> None:
+    """
+    Writes conversations to a binary file, one at a time
+
+    :param compression: "gzip", or "zstd" if zstandard is installed
+    """
+    if compression not in ("gzip", "zstd"):
+        raise Exception(f"Unknown compression: {compression}")
+    if compression == "zstd" and zstandard is None:
+        raise Exception("zstd compression requires the zstandard package")
+    fp.write(DUMP_MAGIC + bytes([DUMP_VERSION]) + compression[0].encode())
+    if compression == "zstd":
+        stream = zstandard.ZstdCompressor().stream_writer(fp, closefd=False)
+    else:
+        stream = gzip.GzipFile(fileobj=fp, mode="wb")
+    with stream:
+        for conversation_id, conversation in conversations:
+            encoded_id = conversation_id.encode()
+            stream.write(
+                _CONVERSATION_HEADER.pack(
+                    len(encoded_id),
+                    len(conversation.messages),
+                )
+                + encoded_id,
+            )
+            for message in conversation.messages:
+                author = message.author.encode()
+                text = message.text.encode()
+                stream.write(
+                    _MESSAGE_HEADER.pack(len(author), message.tokens, len(text))
+                    + author
+                    + text,
+                )
+
+
+def load_conversations(fp: BinaryIO) -> Iterator[tuple[str, Conversation]]:
+    """
+    Reads conversations written by dump_conversations, one at a time
+    """
+    header = fp.read(len(DUMP_MAGIC) + 2)
+    if header[: len(DUMP_MAGIC)] != DUMP_MAGIC:
+        raise ValueError("Not a conversation dump")
+    if header[len(DUMP_MAGIC)] != DUMP_VERSION:
+        raise ValueError(f"Unsupported dump version: {header[len(DUMP_MAGIC)]}")
+    if header[-1:] == b"z":
+        if zstandard is None:
+            raise Exception("zstd compression requires the zstandard package")
+        stream = zstandard.ZstdDecompressor().stream_reader(fp, closefd=False)
+    else:
+        stream = gzip.GzipFile(fileobj=fp, mode="rb")
+    with stream:
+        while True:
+            header = stream.read(_CONVERSATION_HEADER.size)
+            if not header:
+                return
+            header += _read_exactly(stream, _CONVERSATION_HEADER.size - len(header))
+            id_length, count = _CONVERSATION_HEADER.unpack(header)
+            conversation_id = _read_exactly(stream, id_length).decode()
+            conversation = Conversation()
+            for _ in range(count):
+                author_length, tokens, text_length = _MESSAGE_HEADER.unpack(
+                    _read_exactly(stream, _MESSAGE_HEADER.size),
+                )
+                author = _read_exactly(stream, author_length).decode()
+                text = _read_exactly(stream, text_length).decode()
+                conversation.append(Message(text, author, tokens))
+            yield conversation_id, conversation
+
 
 class Conversations:
     """
     Conversation handler
     """
 
-    def __init__(self) -> None:
-        self.conversations: dict[str][Conversation] = {}
+    def __init__(
+        self,
+        strategy=sliding_window,
+        store: MutableMapping = None,
+        tokenizer: Tokenizer = None,
+    ) -> None:
+        # Any mapping of conversation ids to conversations, e.g. ConversationStore
+        self.conversations: MutableMapping[str, Conversation] = (
+            store if store is not None else {}
+        )
+        # Decides which messages to keep when a conversation is too long
+        self.strategy = strategy
+        self.tokenizer: Tokenizer = tokenizer or TOKENIZER
+        # Locks are dropped once no turn of their conversation is running
+        self.locks: WeakValueDictionary[str, asyncio.Lock] = WeakValueDictionary()
+
+    def lock(self, conversation_id: str) -> asyncio.Lock:
+        """
+        Gets the lock that serialises turns of a conversation
+        """
+        lock = self.locks.get(conversation_id)
+        if lock is None:
+            lock = self.locks[conversation_id] = asyncio.Lock()
+        return lock
+
+    def prompt_tokens(self) -> int:
+        """
+        Get the number of tokens in the prompt besides the conversation itself
+        """
+        return self.tokenizer.count(BASE_PROMPT + "ChatGPT: ")
+
+    def count(self, message: Message) -> None:
+        """
+        Counts the tokens of a message with this handler's tokenizer, unless
+        they are known already
+        """
+        if message.tokens is None:
+            message.tokens = self.tokenizer.count(message.render())
 
     def add_message(self, message: Message, conversation_id: str) -> None:
         """
         Adds a message to a conversation
         """
+        self.count(message)
         if conversation_id not in self.conversations:
             self.conversations[conversation_id] = Conversation()
-        self.conversations[conversation_id].messages.append(message)
+        self.conversations[conversation_id].append(message)
+
+    async def aadd_message(self, message: Message, conversation_id: str) -> None:
+        """
+        Adds a message to a conversation from a coroutine
+        """
+        self.add_message(message, conversation_id)
+
+    async def aget(self, conversation_id: str) -> str:
+        """
+        Builds a conversation string from a coroutine
+        """
+        return self.get(conversation_id)
+
+    async def aget_max_tokens(self, conversation_id: str) -> int:
+        """
+        Get the max tokens for the response from a coroutine
+        """
+        return self.get_max_tokens(conversation_id)
 
     def get(self, conversation_id: str) -> str:
         """
@@ -65,14 +545,31 @@ class Conversations:
         """
         if conversation_id not in self.conversations:
             return ""
-        # Build conversation string from messages and check if it's too long
-        conversation = ""
-        for message in self.conversations[conversation_id].messages:
-            conversation += f"{message.author}: {message.text}<|im_sep|>\n\n"
-        if len(ENCODER.encode(conversation)) > 4000 - CONVERSATION_BUFFER:
-            self.purge_history(conversation_id)
-            return self.get(conversation_id)
-        return conversation
+        conversation = self.conversations[conversation_id]
+        # Check if the conversation is too long using the cached token counts
+        budget = 4000 - CONVERSATION_BUFFER - self.prompt_tokens()
+        if conversation.tokens > budget:
+            conversation.trim(
+                *self.strategy(
+                    [message.tokens for message in conversation.messages],
+                    budget,
+                ),
+            )
+        return conversation.render()
+
+    def get_tokens(self, conversation_id: str) -> int:
+        """
+        Get the number of tokens in a conversation
+        """
+        if conversation_id not in self.conversations:
+            return 0
+        return self.conversations[conversation_id].tokens
+
+    def get_max_tokens(self, conversation_id: str) -> int:
+        """
+        Get the max tokens for the response to a conversation
+        """
+        return 4000 - self.prompt_tokens() - self.get_tokens(conversation_id)
 
     def purge_history(self, conversation_id: str, num: int = 1):
         """
@@ -80,9 +577,7 @@ class Conversations:
         """
         if conversation_id not in self.conversations:
             return
-        self.conversations[conversation_id].messages = self.conversations[
-            conversation_id
-        ].messages[num:]
+        self.conversations[conversation_id].purge(num)
 
     def rollback(self, conversation_id: str, num: int = 1):
         """
@@ -90,9 +585,7 @@ class Conversations:
         """
         if conversation_id not in self.conversations:
             return
-        self.conversations[conversation_id].messages = self.conversations[
-            conversation_id
-        ].messages[:-num]
+        self.conversations[conversation_id].rollback(num)
 
     def remove(self, conversation_id: str) -> None:
         """
@@ -101,15 +594,342 @@ class Conversations:
         if conversation_id in self.conversations:
             del self.conversations[conversation_id]
 
+    def items(self) -> Iterator[tuple[str, Conversation]]:
+        """
+        Iterates over all conversations
+        """
+        if isinstance(self.conversations, ConversationStore):
+            yield from self.conversations.scan()
+            return
+        for conversation_id in list(self.conversations):
+            yield conversation_id, self.conversations[conversation_id]
+
+    def put(self, conversation_id: str, conversation: Conversation) -> None:
+        """
+        Adds or replaces a whole conversation
+        """
+        self.conversations[conversation_id] = conversation
+
+    def dump(self, fp: BinaryIO, compression: str = "gzip") -> None:
+        """
+        Writes all conversations to a binary file
+        """
+        dump_conversations(self.items(), fp, compression)
+
+    def load(self, fp: BinaryIO) -> None:
+        """
+        Adds the conversations from a binary file written by dump
+        """
+        for conversation_id, conversation in load_conversations(fp):
+            self.put(conversation_id, conversation)
+
+
+class SharedConversations(Conversations):
+    """
+    Conversation handler backed by a SQLite database in WAL mode, so several
+    worker processes on one host can share conversations
+
+    Every change is a single transaction. A local cache of the cache_size most
+    recently used conversations is kept per process, and a conversation is only
+    reloaded when another process has changed it. The async methods run in the
+    executor, as waiting for another process's write lock would block the loop.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        strategy=sliding_window,
+        timeout: float = 30,
+        tokenizer: Tokenizer = None,
+        cache_size: int = 1000,
+        executor: Executor = None,
+    ) -> None:
+        super().__init__(strategy, store=OrderedDict(), tokenizer=tokenizer)
+        self.cache_size: int = cache_size
+        # None uses the event loop's default thread pool
+        self.executor: Executor = executor
+        # Serialises use of the connection and the cache across executor threads
+        self.db_lock = RLock()
+        # Version of each cached conversation, bumped by every change
+        self.versions: dict[str, int] = {}
+        self.db = sqlite3.connect(
+            path,
+            timeout=timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.__transaction():
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS conversations "
+                "(id TEXT PRIMARY KEY, version INTEGER NOT NULL)",
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS messages "
+                "(conversation_id TEXT NOT NULL, seq INTEGER NOT NULL, "
+                "author TEXT NOT NULL, text TEXT NOT NULL, tokens INTEGER NOT NULL, "
+                "PRIMARY KEY (conversation_id, seq))",
+            )
+
+    @contextmanager
+    def __transaction(self):
+        with self.db_lock:
+            # Take the write lock up front so concurrent writers queue instead
+            # of failing on upgrade
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    async def __offload(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            method,
+            *args,
+        )
+
+    def __version(self, conversation_id: str) -> int:
+        row = self.db.execute(
+            "SELECT version FROM conversations WHERE id = ?",
+            (conversation_id,),
+        ).fetchone()
+        return row[0] if row else None
+
+    def __bump(self, conversation_id: str) -> int:
+        self.db.execute(
+            "INSERT INTO conversations VALUES (?, 1) "
+            "ON CONFLICT (id) DO UPDATE SET version = version + 1",
+            (conversation_id,),
+        )
+        return self.__version(conversation_id)
+
+    def __load(self, conversation_id: str) -> Conversation:
+        with self.db_lock:
+            return self.__load_locked(conversation_id)
+
+    def __load_locked(self, conversation_id: str) -> Conversation:
+        version = self.__version(conversation_id)
+        if version is None:
+            self.conversations.pop(conversation_id, None)
+            self.versions.pop(conversation_id, None)
+            return None
+        if self.versions.get(conversation_id) != version:
+            conversation = Conversation()
+            for author, text, tokens in self.db.execute(
+                "SELECT author, text, tokens FROM messages "
+                "WHERE conversation_id = ? ORDER BY seq",
+                (conversation_id,),
+            ):
+                conversation.append(Message(text, author, tokens))
+            self.conversations[conversation_id] = conversation
+            self.versions[conversation_id] = version
+        else:
+            conversation = self.conversations[conversation_id]
+            self.conversations.move_to_end(conversation_id)
+        while len(self.conversations) > self.cache_size:
+            evicted, _ = self.conversations.popitem(last=False)
+            del self.versions[evicted]
+        return conversation
+
+    def __delete(self, conversation_id: str, order: str, offset: int, num: int):
+        self.db.execute(
+            "DELETE FROM messages WHERE conversation_id = ? AND seq IN "
+            f"(SELECT seq FROM messages WHERE conversation_id = ? ORDER BY seq {order} "
+            "LIMIT ? OFFSET ?)",
+            (conversation_id, conversation_id, num, offset),
+        )
+        self.__bump(conversation_id)
+
+    def add_message(self, message: Message, conversation_id: str) -> None:
+        """
+        Adds a message to a conversation
+        """
+        self.count(message)
+        with self.db_lock:
+            with self.__transaction():
+                self.db.execute(
+                    "INSERT INTO messages "
+                    "SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ? "
+                    "FROM messages WHERE conversation_id = ?",
+                    (
+                        conversation_id,
+                        message.author,
+                        message.text,
+                        message.tokens,
+                        conversation_id,
+                    ),
+                )
+                version = self.__bump(conversation_id)
+            # Only extend the cache if nobody else changed the conversation
+            # meanwhile
+            if self.versions.get(conversation_id) == version - 1:
+                self.conversations[conversation_id].append(message)
+                self.versions[conversation_id] = version
+
+    async def aadd_message(self, message: Message, conversation_id: str) -> None:
+        """
+        Adds a message to a conversation in the executor
+        """
+        await self.__offload(self.add_message, message, conversation_id)
+
+    def get(self, conversation_id: str) -> str:
+        """
+        Builds a conversation string from a conversation id
+        """
+        conversation = self.__load(conversation_id)
+        if conversation is None:
+            return ""
+        budget = 4000 - CONVERSATION_BUFFER - self.prompt_tokens()
+        if conversation.tokens > budget:
+            with self.__transaction():
+                # Decide on the cut with the write lock held
+                conversation = self.__load(conversation_id)
+                if conversation is None:
+                    return ""
+                head, start = self.strategy(
+                    [message.tokens for message in conversation.messages],
+                    budget,
+                )
+                if start > head:
+                    self.__delete(conversation_id, "ASC", head, start - head)
+            # Another process may remove the conversation in between
+            conversation = self.__load(conversation_id)
+            if conversation is None:
+                return ""
+        return conversation.render()
+
+    async def aget(self, conversation_id: str) -> str:
+        """
+        Builds a conversation string in the executor
+        """
+        return await self.__offload(self.get, conversation_id)
+
+    async def aget_max_tokens(self, conversation_id: str) -> int:
+        """
+        Get the max tokens for the response in the executor
+        """
+        return await self.__offload(self.get_max_tokens, conversation_id)
+
+    def get_tokens(self, conversation_id: str) -> int:
+        """
+        Get the number of tokens in a conversation
+        """
+        conversation = self.__load(conversation_id)
+        return conversation.tokens if conversation is not None else 0
+
+    def purge_history(self, conversation_id: str, num: int = 1):
+        """
+        Remove oldest messages from a conversation
+        """
+        with self.__transaction():
+            if self.__version(conversation_id) is not None:
+                self.__delete(conversation_id, "ASC", 0, num)
+
+    def rollback(self, conversation_id: str, num: int = 1):
+        """
+        Remove latest messages from a conversation
+        """
+        with self.__transaction():
+            if self.__version(conversation_id) is not None:
+                self.__delete(conversation_id, "DESC", 0, num)
+
+    def remove(self, conversation_id: str) -> None:
+        """
+        Removes a conversation
+        """
+        with self.__transaction():
+            self.db.execute(
+                "DELETE FROM messages WHERE conversation_id = ?",
+                (conversation_id,),
+            )
+            self.db.execute(
+                "DELETE FROM conversations WHERE id = ?",
+                (conversation_id,),
+            )
+            self.conversations.pop(conversation_id, None)
+            self.versions.pop(conversation_id, None)
+
+    def items(self) -> Iterator[tuple[str, Conversation]]:
+        """
+        Iterates over all conversations
+        """
+        with self.db_lock:
+            conversation_ids = self.db.execute(
+                "SELECT id FROM conversations",
+            ).fetchall()
+        for (conversation_id,) in conversation_ids:
+            conversation = self.__load(conversation_id)
+            if conversation is not None:
+                yield conversation_id, conversation
+
+    def put(self, conversation_id: str, conversation: Conversation) -> None:
+        """
+        Adds or replaces a whole conversation
+        """
+        with self.__transaction():
+            self.db.execute(
+                "DELETE FROM messages WHERE conversation_id = ?",
+                (conversation_id,),
+            )
+            self.db.executemany(
+                "INSERT INTO messages VALUES (?, ?, ?, ?, ?)",
+                (
+                    (conversation_id, seq, message.author, message.text, message.tokens)
+                    for seq, message in enumerate(conversation.messages, 1)
+                ),
+            )
+            self.__bump(conversation_id)
+
+    def close(self) -> None:
+        """
+        Closes the database
+        """
+        with self.db_lock:
+            self.db.close()
 
-BASE_PROMPT = (
-    os.environ.get("BASE_PROMPT")
-    or """You are ChatGPT, a large language model by OpenAI. Respond conversationally\n\n\n"""
-)
 
 PROXY_URL = os.environ.get("PROXY_URL") or "https://chat.duti.tech"
 
 
+@dataclass(frozen=True)
+class Settings:
+    """
+    Completion settings
+    """
+
+    temperature: float = 0.5
+    top_p: float = 1
+    presence_penalty: float = 1.0
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        """
+        Reads the settings from the environment
+        """
+        return cls(
+            temperature=float(os.environ.get("TEMPERATURE") or 0.5),
+            top_p=float(os.environ.get("TOP_P") or 1),
+            presence_penalty=float(os.environ.get("PRESENCE_PENALTY") or 1.0),
+        )
+
+    def body(self, paid: bool) -> dict:
+        """
+        Builds the request body shared by every completion
+        """
+        return {
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "stop": ["<|im_end|>", "<|im_sep|>"],
+            "presence_penalty": self.presence_penalty,
+            "paid": paid,
+            "stream": True,
+        }
+
+
 class Chatbot:
     """
     Handles everything seamlessly
@@ -123,6 +943,15 @@ class Chatbot:
         proxy=None,
         insecure: bool = False,
         session_token: str = None,
+        conversations: Conversations = None,
+        limits: httpx.Limits = None,
+        settings: Settings = None,
+        hedge: bool = False,
+        hedge_percentile: float = 0.95,
+        hedge_delay: float = 2.0,
+        hedge_rate: float = 0.1,
+        tokenizer: Tokenizer = None,
+        tracer: Tracer = None,
     ) -> None:
         self.proxy = proxy
         self.email: str = email
@@ -131,80 +960,209 @@ class Chatbot:
         self.insecure: bool = insecure
         self.api_key: str
         self.paid: bool = paid
-        self.conversations = Conversations()
-        self.login(email, password, proxy, insecure, session_token)
+        if (
+            conversations is not None
+            and tokenizer is not None
+            and tokenizer is not conversations.tokenizer
+        ):
+            raise Exception(
+                "Pass the tokenizer to Conversations when passing conversations",
+            )
+        self.conversations = conversations or Conversations(tokenizer=tokenizer)
+        self.tokenizer: Tokenizer = self.conversations.tokenizer
+        self.settings: Settings = settings or Settings.from_env()
+        # Request body without the prompt, built once
+        self.config: dict = self.settings.body(paid)
+        # Hooks registered on the tracer receive timed spans and events
+        self.tracer: Tracer = tracer or Tracer()
+        # Long-lived client so connections are pooled and kept alive across asks
+        self.transport = HTTPXTransport(
+            proxy=self.proxy,
+            limits=limits,
+            timeout=1080,
+            tracer=self.tracer,
+        )
+        self.session: httpx.AsyncClient = self.transport.client
+        # Hedging: send a duplicate request when the first byte is late
+        self.hedge: bool = hedge
+        self.hedge_percentile: float = hedge_percentile
+        self.hedge_delay: float = hedge_delay
+        self.hedge_rate: float = hedge_rate
+        self.requests: int = 0
+        self.hedged: int = 0
+        # Recent times to first byte, used to pick the hedging delay
+        self.first_byte_times: deque[float] = deque(maxlen=100)
+        with self.tracer.span("auth_refresh"):
+            self.login(email, password, proxy, insecure, session_token)
+
+    async def __aenter__(self) -> "Chatbot":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        """
+        Closes the HTTP client and its pooled connections
+        """
+        await self.transport.aclose()
 
     async def ask(self, prompt: str, conversation_id: str = None) -> dict:
         """
         Gets a response from the API
         """
+        async for data, _ in self.__stream(prompt, conversation_id):
+            yield data
+
+    async def ask_stream(self, prompt: str, conversation_id: str = None) -> str:
+        """
+        Gets a response from the API as text deltas
+        """
+        async for _, text in self.__stream(prompt, conversation_id):
+            if text:
+                yield text
+
+    async def __stream(self, prompt: str, conversation_id: str = None):
         if conversation_id is None:
             conversation_id = "default"
-        self.conversations.add_message(
-            Message(prompt, "User"),
-            conversation_id=conversation_id,
-        )
-        conversation: str = self.conversations.get(conversation_id)
-        # Build request body
-        body = self.__get_config()
-        body["prompt"] = BASE_PROMPT + conversation + "ChatGPT: "
-        body["max_tokens"] = get_max_tokens(conversation)
-        async with httpx.AsyncClient(proxies=self.proxy if self.proxy else None).stream(
-            method="POST",
-            url=PROXY_URL + "/completions",
-            data=json.dumps(body),
-            headers={"Authorization": f"Bearer {self.api_key}"},
-            timeout=1080,
-        ) as response:
-            full_result = ""
-            async for line in response.aiter_lines():
-                if response.status_code == 429:
-                    print("error: " + "Too many requests")
-                    raise Exception("Too many requests")
-                elif response.status_code == 523:
-                    print(
-                        "error: "
-                        + "Origin is unreachable. Ensure that you are authenticated and are using the correct pricing model.",
-                    )
-                    raise Exception(
-                        "Origin is unreachable. Ensure that you are authenticated and are using the correct pricing model.",
-                    )
-                elif response.status_code == 503:
-                    print("error: " + "OpenAI error!")
-                    raise Exception("OpenAI error!")
-                elif response.status_code != 200:
-                    print("error: " + "Unknown error")
-                    raise Exception("Unknown error")
-                line = line.strip()
-                if line == "\n" or line == "":
-                    continue
-                if line == "data: [DONE]":
-                    break
-                try:
-                    # Remove "data: " from the start of the line
-                    data = json.loads(line[6:])
-                    if data is None:
+        # Turns of one conversation run one at a time, in the order they arrive
+        async with self.conversations.lock(conversation_id):
+            await self.conversations.aadd_message(
+                await self.__message(prompt, "User"),
+                conversation_id=conversation_id,
+            )
+            conversation: str = await self.conversations.aget(conversation_id)
+            # Build request body
+            body = dict(self.config)
+            body["prompt"] = BASE_PROMPT + conversation + "ChatGPT: "
+            body["max_tokens"] = await self.conversations.aget_max_tokens(
+                conversation_id,
+            )
+            response, lines = await self.__open(json.dumps(body))
+            try:
+                full_result = []
+                events = 0
+                async for line in lines:
+                    line = line.strip()
+                    if not line:
                         continue
-                    full_result += data["choices"][0]["text"].replace("<|im_end|>", "")
-                    if "choices" not in data:
+                    if line == "data: [DONE]":
+                        break
+                    try:
+                        # Remove "data: " from the start of the line
+                        data = json.loads(line[6:])
+                    except json.JSONDecodeError:
                         continue
-                    yield data
-                except json.JSONDecodeError:
-                    continue
-            self.conversations.add_message(
-                Message(full_result, "ChatGPT"),
+                    if data is None or "choices" not in data:
+                        continue
+                    text = data["choices"][0]["text"].replace("<|im_end|>", "")
+                    data["choices"][0]["text"] = text
+                    full_result.append(text)
+                    events += 1
+                    if self.tracer:
+                        self.tracer.event("event", index=events, length=len(text))
+                    yield data, text
+            finally:
+                await response.aclose()
+            self.tracer.event("stream_end", events=events)
+            await self.conversations.aadd_message(
+                await self.__message("".join(full_result), "ChatGPT"),
                 conversation_id=conversation_id,
             )
 
-    def __get_config(self) -> dict:
-        return {
-            "temperature": float(os.environ.get("TEMPERATURE") or 0.5),
-            "top_p": float(os.environ.get("TOP_P") or 1),
-            "stop": ["<|im_end|>", "<|im_sep|>"],
-            "presence_penalty": float(os.environ.get("PRESENCE_PENALTY") or 1.0),
-            "paid": self.paid,
-            "stream": True,
-        }
+    async def __message(self, text: str, author: str) -> Message:
+        """
+        Creates a message, counting its tokens off the event loop
+        """
+        return Message(
+            text,
+            author,
+            await self.tokenizer.acount(Message.format(text, author)),
+        )
+
+    async def __send(self, data: str):
+        """
+        Sends a completion request and waits for the first line of the response
+        """
+        start = time.monotonic()
+        response = await self.transport.send(
+            "POST",
+            PROXY_URL + "/completions",
+            data=data,
+            headers={"Authorization": f"Bearer {self.api_key}"},
+            stream=True,
+        )
+        try:
+            if response.status_code != 200:
+                await response.aread()
+                check_response(response)
+            lines = response.aiter_lines()
+            try:
+                first_line = await lines.__anext__()
+            except StopAsyncIteration:
+                first_line = None
+        except BaseException:
+            await response.aclose()
+            raise
+        self.first_byte_times.append(time.monotonic() - start)
+        self.tracer.event("first_byte")
+
+        async def prepend():
+            if first_line is not None:
+                yield first_line
+            async for line in lines:
+                yield line
+
+        return response, prepend()
+
+    async def __open(self, data: str):
+        """
+        Opens a completion stream, hedging it with a duplicate request if enabled
+        """
+        self.requests += 1
+        if not self.hedge or self.hedged >= self.hedge_rate * self.requests:
+            return await self.__send(data)
+        if len(self.first_byte_times) >= 20:
+            times = sorted(self.first_byte_times)
+            delay = times[min(int(len(times) * self.hedge_percentile), len(times) - 1)]
+        else:
+            delay = self.hedge_delay
+        tasks = [asyncio.create_task(self.__send(data))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                return tasks[0].result()
+            self.hedged += 1
+            tasks.append(asyncio.create_task(self.__send(data)))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                winners = [task for task in done if task.exception() is None]
+                if not winners:
+                    error = error or next(iter(done)).exception()
+                    continue
+                # Keep the first stream that started and cancel or close the rest
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                for task in winners[1:]:
+                    await task.result()[0].aclose()
+                return winners[0].result()
+            raise error
+        except BaseException:
+            # Also reached when the caller is cancelled: stop the requests and
+            # close any stream already opened, so no pooled connection leaks
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for task in tasks:
+                if not task.cancelled() and task.exception() is None:
+                    await task.result()[0].aclose()
+            raise
 
     def login(self, email, password, proxy, insecure, session_token) -> None:
         """
@@ -358,14 +1316,15 @@ async def main():
                 if commands(prompt):
                     continue
             print("ChatGPT:")
-            async for line in chatbot.ask(prompt=prompt):
-                result = line["choices"][0]["text"].replace("<|im_end|>", "")
-                print(result, end="")
+            async for text in chatbot.ask_stream(prompt=prompt):
+                print(text, end="")
                 sys.stdout.flush()
             print()
     except KeyboardInterrupt:
         print("Exiting...")
         sys.exit(0)
+    finally:
+        await chatbot.aclose()
 
 
 if __name__ == "__main__":
@@ -1,3 +1,7 @@
+import logging
 from os import environ
 
+# Applications decide where log records go, see revChatGPT.logs.start_logging
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
 environ["CHATGPT_BASE_URL"] = "https://apps.openai.com/"
@@ -0,0 +1,158 @@
+"""
+Clearance broker shared by Unofficial workers
+"""
+import argparse
+import json
+import os
+import socketserver
+import threading
+from time import time
+
+from .Unofficial import Chatbot
+
+
+class ClearanceBroker:
+    """
+    Owns the browser that obtains Cloudflare clearance and hands the result to clients
+    """
+
+    def __init__(self, config, ttl=1800) -> None:
+        self.config = config
+        self.ttl = ttl
+        self.chatbot = None
+        self.clearance = None
+        self.expires = 0
+        # Held while refreshing, so concurrent refresh requests share one refresh
+        self.lock = threading.Lock()
+
+    def __refresh(self):
+        if self.chatbot is None:
+            self.chatbot = Chatbot(self.config, no_refresh=True)
+            clearance = self.chatbot.get_clearance()
+        else:
+            clearance = self.chatbot.refresh_clearance()
+        self.expires = time() + self.ttl
+        self.clearance = dict(clearance, expires=self.expires)
+
+    def get(self):
+        """
+        Get the current clearance, obtaining one if there is none
+        """
+        with self.lock:
+            if self.clearance is None or time() >= self.expires:
+                self.__refresh()
+            return self.clearance
+
+    def refresh(self, cf_clearance=None):
+        """
+        Replace a rejected clearance, unless it was already replaced
+        """
+        with self.lock:
+            if (
+                self.clearance is None
+                or time() >= self.expires
+                or cf_clearance is None
+                or self.clearance["cf_clearance"] == cf_clearance
+            ):
+                self.__refresh()
+            return self.clearance
+
+    def close(self):
+        """
+        Quit the browser
+        """
+        if self.chatbot is not None:
+            self.chatbot.close()
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    """
+    Serves one newline-delimited JSON request per connection
+    """
+
+    def handle(self):
+        broker = self.server.broker
+        try:
+            request = json.loads(self.rfile.readline())
+            if request.get("op") == "get":
+                response = broker.get()
+            elif request.get("op") == "refresh":
+                response = broker.refresh(request.get("cf_clearance"))
+            else:
+                response = {"error": f"Unknown op: {request.get('op')}"}
+        except Exception as exc:
+            response = {"error": str(exc)}
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class BrokerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, broker) -> None:
+        if os.path.exists(path):
+            os.remove(path)
+        # Only the owner may ask for credentials
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, BrokerHandler)
+        finally:
+            os.umask(umask)
+        self.broker = broker
+
+
+def main():
+    """
+    Run a clearance broker
+    """
+    parser = argparse.ArgumentParser(
+        description="Share Cloudflare clearance between Unofficial workers",
+    )
+    parser.add_argument(
+        "--socket",
+        help="Path of the Unix socket to listen on",
+        default=os.path.join(
+            os.getenv("XDG_RUNTIME_DIR") or "/tmp",
+            "revChatGPT-broker.sock",
+        ),
+    )
+    parser.add_argument(
+        "--config",
+        help="JSON file with proxy and browser options",
+        required=False,
+    )
+    parser.add_argument(
+        "--proxy",
+        help="Proxy used by the browser and the workers",
+        required=False,
+    )
+    parser.add_argument(
+        "--ttl",
+        help="Seconds before a clearance is refreshed regardless of rejections",
+        type=int,
+        default=1800,
+    )
+    args = parser.parse_args()
+    config = {}
+    if args.config:
+        with open(args.config, encoding="utf-8") as f:
+            config = json.load(f)
+    if args.proxy:
+        config["proxy"] = args.proxy
+    # Workers report their rejected clearance, so never serve from a stale cache
+    config.pop("clearance_cache", None)
+    config.pop("clearance_broker", None)
+    config.setdefault("warm_browser", True)
+    server = BrokerServer(args.socket, ClearanceBroker(config, ttl=args.ttl))
+    print(f"Clearance broker listening on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Exiting...")
+    finally:
+        server.server_close()
+        server.broker.close()
+        os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
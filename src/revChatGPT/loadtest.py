@@ -0,0 +1,375 @@
+"""
+Load generator for the V1, V2 and Unofficial clients
+"""
+import argparse
+import asyncio
+import json
+import threading
+import uuid
+from time import monotonic
+from time import sleep
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+class Pacer:
+    """
+    Hands out request slots at a fixed rate until the request count or
+    duration is exhausted
+    """
+
+    def __init__(self, rate=None, requests=None, duration=None) -> None:
+        self.rate = rate
+        self.requests = requests
+        self.duration = duration
+        self.lock = threading.Lock()
+        self.issued = 0
+        self.start = monotonic()
+
+    def restart(self) -> None:
+        """
+        Start the clock now, e.g. once the clients have logged in
+        """
+        self.start = monotonic()
+
+    def next(self):
+        """
+        Get the index of the next request and how long to wait before sending
+        it, or None when the run is over
+        """
+        with self.lock:
+            if self.requests is not None and self.issued >= self.requests:
+                return None
+            now = monotonic()
+            if self.duration is not None and now - self.start >= self.duration:
+                return None
+            index = self.issued
+            self.issued += 1
+        delay = self.start + index / self.rate - now if self.rate else 0
+        return index, max(delay, 0)
+
+
+class Result:
+    __slots__ = ("latency", "first_token", "tokens", "error")
+
+    def __init__(self, latency, first_token=None, tokens=0, error=None) -> None:
+        self.latency = latency
+        self.first_token = first_token
+        self.tokens = tokens
+        self.error = error
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile of a sorted list
+    """
+    if not values:
+        return None
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def count_tokens(text):
+    if tiktoken is None:
+        return len(text.split())
+    if not hasattr(count_tokens, "encoding"):
+        count_tokens.encoding = tiktoken.get_encoding("gpt2")
+    return len(count_tokens.encoding.encode(text))
+
+
+def describe(exc):
+    """
+    Name an error, with its status code when it came from the server
+    """
+    code = getattr(exc, "code", None)
+    return type(exc).__name__ if code is None else f"{type(exc).__name__} {code}"
+
+
+def summarize(results, elapsed):
+    """
+    Aggregate per-request results into a report
+    """
+    ok = [result for result in results if result.error is None]
+    errors = {}
+    for result in results:
+        if result.error is not None:
+            errors[result.error] = errors.get(result.error, 0) + 1
+    latency = sorted(result.latency for result in ok)
+    first_token = sorted(
+        result.first_token for result in ok if result.first_token is not None
+    )
+    tokens = sum(result.tokens for result in ok)
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "error_rate": (len(results) - len(ok)) / len(results) if results else 0,
+        "error_types": errors,
+        "elapsed": elapsed,
+        "throughput": len(results) / elapsed if elapsed else 0,
+        "tokens": tokens,
+        "tokens_per_second": tokens / elapsed if elapsed else 0,
+        "first_token": {
+            "p50": percentile(first_token, 0.5),
+            "p90": percentile(first_token, 0.9),
+            "p99": percentile(first_token, 0.99),
+        },
+        "latency": {
+            "p50": percentile(latency, 0.5),
+            "p90": percentile(latency, 0.9),
+            "p99": percentile(latency, 0.99),
+        },
+    }
+
+
+def run_sync(make_chatbot, prompts, pacer, concurrency):
+    """
+    Drive a blocking client with one Chatbot per worker thread
+    """
+    results = []
+    errors = []
+    lock = threading.Lock()
+    # Logins can take a while, e.g. a browser spawn for Unofficial, so the clock
+    # starts once every worker has its Chatbot
+    ready = threading.Barrier(concurrency, action=pacer.restart)
+
+    def worker():
+        try:
+            chatbot = make_chatbot()
+        except Exception as exc:
+            errors.append(exc)
+            ready.abort()
+            return
+        try:
+            ready.wait()
+        except threading.BrokenBarrierError:
+            return
+        # Both clients yield the message so far; Unofficial.ask only returns the end
+        ask = getattr(chatbot, "ask_stream", chatbot.ask)
+        while True:
+            slot = pacer.next()
+            if slot is None:
+                return
+            index, delay = slot
+            sleep(delay)
+            prompt = prompts[index % len(prompts)]
+            # Every request starts a new conversation so history does not grow
+            chatbot.reset_chat()
+            start = monotonic()
+            first_token = None
+            message = ""
+            try:
+                for data in ask(prompt):
+                    if first_token is None and data["message"]:
+                        first_token = monotonic() - start
+                    message = data["message"]
+                result = Result(
+                    monotonic() - start,
+                    first_token,
+                    count_tokens(message),
+                )
+            except Exception as exc:
+                result = Result(monotonic() - start, error=describe(exc))
+            with lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+async def run_async(chatbot, prompts, pacer, concurrency):
+    """
+    Drive the asynchronous client with concurrent tasks sharing one Chatbot
+    """
+    results = []
+
+    async def worker():
+        while True:
+            slot = pacer.next()
+            if slot is None:
+                return
+            index, delay = slot
+            await asyncio.sleep(delay)
+            prompt = prompts[index % len(prompts)]
+            conversation_id = str(uuid.uuid4())
+            start = monotonic()
+            first_token = None
+            message = []
+            try:
+                async for text in chatbot.ask_stream(prompt, conversation_id):
+                    if first_token is None:
+                        first_token = monotonic() - start
+                    message.append(text)
+                result = Result(
+                    monotonic() - start,
+                    first_token,
+                    count_tokens("".join(message)),
+                )
+            except Exception as exc:
+                result = Result(monotonic() - start, error=describe(exc))
+            finally:
+                chatbot.conversations.remove(conversation_id)
+            results.append(result)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results
+
+
+def load_prompts(path):
+    """
+    Read prompts from a text file with one prompt per line, or a JSONL file
+    with a "prompt" field per line
+    """
+    prompts = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                line = json.loads(line)["prompt"]
+            prompts.append(line)
+    if not prompts:
+        raise Exception("No prompts found in " + path)
+    return prompts
+
+
+def run(args, config, prompts):
+    pacer = Pacer(
+        rate=args.rate,
+        requests=args.requests,
+        duration=args.duration,
+    )
+    if args.client == "v2":
+        from . import V2
+
+        if args.base_url:
+            V2.PROXY_URL = args.base_url.rstrip("/")
+
+        async def main():
+            async with V2.Chatbot(
+                config.get("email"),
+                config.get("password"),
+                paid=config.get("paid", False),
+                proxy=config.get("proxy"),
+                insecure=config.get("insecure", False),
+                session_token=config.get("session_token"),
+            ) as chatbot:
+                pacer.restart()
+                return await run_async(chatbot, prompts, pacer, args.concurrency)
+
+        results = asyncio.run(main())
+    else:
+        if args.client == "v1":
+            from . import V1 as client
+        else:
+            from . import Unofficial as client
+        if args.base_url:
+            client.BASE_URL = args.base_url.rstrip("/") + "/"
+        results = run_sync(
+            lambda: client.Chatbot(dict(config)),
+            prompts,
+            pacer,
+            args.concurrency,
+        )
+    return summarize(results, monotonic() - pacer.start)
+
+
+def print_report(report):
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.0f} ms"
+
+    print(f"Requests:        {report['requests']} in {report['elapsed']:.1f} s")
+    print(f"Throughput:      {report['throughput']:.2f} req/s")
+    print(
+        f"Errors:          {report['errors']} ({report['error_rate']:.1%})",
+    )
+    for error, count in report["error_types"].items():
+        print(f"  {error}: {count}")
+    print(f"Tokens/s:        {report['tokens_per_second']:.1f}")
+    for name, label in (("first_token", "First token"), ("latency", "Latency")):
+        values = report[name]
+        print(
+            f"{label + ':':<17}p50 {ms(values['p50'])}, "
+            f"p90 {ms(values['p90'])}, p99 {ms(values['p99'])}",
+        )
+
+
+def main():
+    """
+    Run a load test
+    """
+    parser = argparse.ArgumentParser(
+        description="Measure the throughput a client configuration sustains",
+    )
+    parser.add_argument(
+        "--client",
+        help="Client to drive",
+        choices=["v1", "v2", "unofficial"],
+        default="v1",
+    )
+    parser.add_argument(
+        "--base-url",
+        help="Base URL of the server under test",
+        required=False,
+    )
+    parser.add_argument(
+        "--config",
+        help="JSON file with the client configuration (credentials, proxy)",
+        required=True,
+    )
+    parser.add_argument(
+        "--prompts",
+        help="Prompt corpus, one prompt per line or JSONL with a prompt field",
+        required=True,
+    )
+    parser.add_argument(
+        "--concurrency",
+        help="Number of requests in flight",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--rate",
+        help="Target requests per second (default: as fast as possible)",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--requests",
+        help="Total number of requests to send",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--duration",
+        help="Seconds to keep sending requests",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--json",
+        help="Print the report as JSON",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    if args.requests is None and args.duration is None:
+        args.requests = 10 * args.concurrency
+    with open(args.config, encoding="utf-8") as f:
+        config = json.load(f)
+    report = run(args, config, load_prompts(args.prompts))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Opt-in logging that keeps file I/O off the request path
+"""
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
+
+FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(funcName)s - %(message)s"
+
+
+def start_logging(
+    filename="chatbot.log",
+    level=logging.INFO,
+    handlers=None,
+    logger="revChatGPT",
+):
+    """
+    Route log records of a logger through a queue to handlers running on a
+    background thread, so slow disks do not stall streaming responses.
+
+    :param filename: Log file used when no handlers are given
+    :param level: Level of the logger
+    :param handlers: Handlers to write records with
+    :param logger: Name of the logger, None for the root logger
+    :return: Function that flushes the queue and detaches the handlers
+    """
+    if handlers is None:
+        handler = logging.FileHandler(filename, encoding="utf-8", delay=True)
+        handler.setFormatter(logging.Formatter(FORMAT))
+        handlers = [handler]
+    records = queue.SimpleQueue()
+    queue_handler = QueueHandler(records)
+    target = logging.getLogger(logger)
+    target.addHandler(queue_handler)
+    target.setLevel(level)
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+
+    def stop():
+        atexit.unregister(stop)
+        target.removeHandler(queue_handler)
+        listener.stop()
+        for handler in handlers:
+            handler.close()
+
+    atexit.register(stop)
+    return stop
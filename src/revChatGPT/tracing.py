@@ -0,0 +1,87 @@
+"""
+Timed spans and events emitted by the chat clients
+"""
+import logging
+from contextlib import contextmanager
+from contextlib import nullcontext
+from time import monotonic
+
+log = logging.getLogger(__name__)
+
+# Returned by Tracer.span while no hook is registered
+NULL_SPAN = nullcontext()
+
+
+class Tracer:
+    """
+    Dispatches spans and events to hooks called as
+    hook(name, start, duration, attributes). Events have a duration of None.
+    Nothing is timed or allocated while no hook is registered, and callers
+    on hot paths check `if tracer:` before building attributes.
+    """
+
+    def __init__(self, hooks=()) -> None:
+        self.hooks = list(hooks)
+
+    def __bool__(self) -> bool:
+        return bool(self.hooks)
+
+    def add_hook(self, hook):
+        """
+        Register a hook, returning it so this can be used as a decorator
+        """
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook) -> None:
+        self.hooks.remove(hook)
+
+    def event(self, name, **attributes) -> None:
+        """
+        Emit a point in time
+        """
+        if self.hooks:
+            self.__emit(name, monotonic(), None, attributes)
+
+    def span(self, name, **attributes):
+        """
+        Time a block. The context manager yields the attributes, which the
+        block may add to, or None if no hook is registered.
+        """
+        if not self.hooks:
+            return NULL_SPAN
+        return self.__span(name, attributes)
+
+    @contextmanager
+    def __span(self, name, attributes):
+        start = monotonic()
+        try:
+            yield attributes
+        except BaseException as exc:
+            attributes["error"] = type(exc).__name__
+            raise
+        finally:
+            self.__emit(name, start, monotonic() - start, attributes)
+
+    def __emit(self, name, start, duration, attributes) -> None:
+        for hook in tuple(self.hooks):
+            try:
+                hook(name, start, duration, attributes)
+            except Exception:
+                log.exception("Tracing hook %r failed", hook)
+
+
+def logging_hook(logger, level=logging.DEBUG):
+    """
+    Make a hook that logs spans and events
+    """
+
+    def hook(name, start, duration, attributes):
+        if not logger.isEnabledFor(level):
+            return
+        if duration is None:
+            logger.log(level, "%s %s", name, attributes)
+        else:
+            logger.log(level, "%s took %.1f ms %s", name, duration * 1000, attributes)
+
+    return hook
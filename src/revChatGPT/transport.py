@@ -0,0 +1,347 @@
+"""
+HTTP transports shared by the V1, V2 and Unofficial clients
+"""
+import asyncio
+import logging
+import threading
+from time import monotonic
+from time import sleep
+
+import requests
+
+if __package__:
+    from .tracing import Tracer
+else:
+    # Imported by a module that runs as a script
+    from tracing import Tracer
+
+log = logging.getLogger(__name__)
+
+# Status codes worth retrying for idempotent requests
+RETRY_STATUS = frozenset({502, 503, 504})
+
+# Explanations for status codes whose body is not helpful
+STATUS_MESSAGES = {
+    429: "Too many requests",
+    503: "OpenAI error!",
+    523: "Origin is unreachable. Ensure that you are authenticated and are using the correct pricing model.",
+}
+
+# httpx trace extension events reported to the tracer, and their names
+TRACE_EVENTS = {
+    "connection.connect_tcp.complete": "connect",
+    "connection.start_tls.complete": "tls_handshake",
+    "http11.send_request_body.complete": "request_sent",
+    "http2.send_request_body.complete": "request_sent",
+    "http11.receive_response_headers.complete": "response_headers",
+    "http2.receive_response_headers.complete": "response_headers",
+}
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+    source: str
+    message: str
+    code: int
+
+
+def check_response(response, source="OpenAI") -> None:
+    """
+    Raise an Error if the response is not successful
+    """
+    if response.status_code != 200:
+        log.error("Request failed with %s: %s", response.status_code, response.text)
+        error = Error(
+            f"{response.status_code}: "
+            + STATUS_MESSAGES.get(response.status_code, response.text),
+        )
+        error.source = source
+        error.code = response.status_code
+        error.message = response.text
+        raise error
+
+
+class Metrics:
+    """
+    Request counters and latency totals of a transport
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.status: dict[int, int] = {}
+        self.seconds = 0.0
+
+    def record(self, status_code, seconds) -> None:
+        with self.lock:
+            self.requests += 1
+            self.seconds += seconds
+            if status_code is None:
+                self.errors += 1
+            else:
+                self.status[status_code] = self.status.get(status_code, 0) + 1
+
+    def retried(self) -> None:
+        with self.lock:
+            self.retries += 1
+
+    def snapshot(self) -> dict:
+        """
+        Get a copy of the counters
+        """
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "errors": self.errors,
+                "status": dict(self.status),
+                "seconds": self.seconds,
+            }
+
+
+class BaseTransport:
+    """
+    Retry policy, metrics and tracer shared by the blocking and asynchronous
+    transports
+    """
+
+    # Exceptions of the backend that mean the request never got a response
+    retry_exceptions: tuple = ()
+
+    def __init__(self, timeout=360, retries=2, backoff=0.5, tracer=None) -> None:
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.metrics = Metrics()
+        self.tracer = tracer or Tracer()
+
+    def _attempts(self, method) -> int:
+        """
+        Idempotent requests are retried on connection errors and gateway errors
+        """
+        return 1 + (self.retries if method in ("GET", "HEAD") else 0)
+
+    def _delay(self, attempt) -> float:
+        return self.backoff * 2 ** (attempt - 1)
+
+    def _is_final(self, response, attempt, attempts) -> bool:
+        return response.status_code not in RETRY_STATUS or attempt == attempts - 1
+
+
+class Transport(BaseTransport):
+    """
+    Blocking transport. Backends implement _send; retries, timeouts and
+    metrics are handled here.
+    """
+
+    def _send(self, method, url, data, headers, cookies, timeout, stream):
+        raise NotImplementedError
+
+    def request(
+        self,
+        method,
+        url,
+        data=None,
+        headers=None,
+        cookies=None,
+        timeout=None,
+        stream=False,
+    ):
+        """
+        Send a request. Idempotent requests are retried on connection errors
+        and gateway errors.
+        """
+        attempts = self._attempts(method)
+        for attempt in range(attempts):
+            if attempt:
+                self.metrics.retried()
+                sleep(self._delay(attempt))
+            if self.tracer:
+                self.tracer.event(
+                    "request_sent",
+                    method=method,
+                    url=url,
+                    attempt=attempt,
+                )
+            start = monotonic()
+            try:
+                response = self._send(
+                    method,
+                    url,
+                    data,
+                    headers,
+                    cookies,
+                    timeout or self.timeout,
+                    stream,
+                )
+            except self.retry_exceptions:
+                self.metrics.record(None, monotonic() - start)
+                if attempt == attempts - 1:
+                    raise
+                continue
+            self.metrics.record(response.status_code, monotonic() - start)
+            if self.tracer:
+                self.tracer.event("response_headers", status=response.status_code)
+            if self._is_final(response, attempt, attempts):
+                return response
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+
+class RequestsTransport(Transport):
+    """
+    Transport backed by requests.Session
+    """
+
+    retry_exceptions = (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+    )
+
+    def __init__(self, proxy=None, session=None, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.session = session or requests.Session()
+        if proxy:
+            self.session.proxies.update({"http": proxy, "https": proxy})
+
+    def _send(self, method, url, data, headers, cookies, timeout, stream):
+        return self.session.request(
+            method,
+            url,
+            data=data,
+            headers=headers,
+            cookies=cookies,
+            timeout=timeout,
+            stream=stream,
+        )
+
+
+class TLSClientTransport(Transport):
+    """
+    Transport backed by tls_client.Session, which mimics a browser's TLS
+    fingerprint. It cannot stream responses.
+    """
+
+    def __init__(self, proxy=None, client_identifier="chrome_108", **kwargs) -> None:
+        import tls_client
+        from tls_client.exceptions import TLSClientExeption
+
+        super().__init__(**kwargs)
+        self.session = tls_client.Session(client_identifier=client_identifier)
+        if proxy:
+            self.session.proxies.update({"http": proxy, "https": proxy})
+        self.retry_exceptions = (TLSClientExeption,)
+
+    def _send(self, method, url, data, headers, cookies, timeout, stream):
+        return self.session.execute_request(
+            method,
+            url,
+            data=data,
+            headers=headers,
+            cookies=cookies,
+            timeout_seconds=timeout,
+        )
+
+
+class MockTransport(Transport):
+    """
+    Test double that answers requests with handler(method, url, data, headers)
+    """
+
+    def __init__(self, handler, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.handler = handler
+        self.session = requests.Session()
+
+    def _send(self, method, url, data, headers, cookies, timeout, stream):
+        return self.handler(method, url, data, headers)
+
+
+class HTTPXTransport(BaseTransport):
+    """
+    Asynchronous transport backed by a pooled httpx.AsyncClient
+    """
+
+    def __init__(
+        self,
+        proxy=None,
+        limits=None,
+        timeout=1080,
+        transport=None,
+        tracer=None,
+        **kwargs,
+    ) -> None:
+        """
+        :param transport: httpx transport to use instead of the network, e.g. httpx.MockTransport
+        """
+        import httpx
+
+        super().__init__(timeout=timeout, tracer=tracer, **kwargs)
+        self.retry_exceptions = (httpx.TransportError,)
+        self.client = httpx.AsyncClient(
+            proxy=proxy if proxy else None,
+            limits=limits
+            or httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=20,
+                keepalive_expiry=60,
+            ),
+            timeout=timeout,
+            transport=transport,
+        )
+
+    async def send(self, method, url, data=None, headers=None, stream=False):
+        """
+        Send a request, leaving the body unread if stream is set. Idempotent
+        requests are retried like Transport.request does.
+        """
+        attempts = self._attempts(method)
+        for attempt in range(attempts):
+            if attempt:
+                self.metrics.retried()
+                await asyncio.sleep(self._delay(attempt))
+            start = monotonic()
+            try:
+                response = await self.client.send(
+                    self.client.build_request(
+                        method=method,
+                        url=url,
+                        data=data,
+                        headers=headers,
+                        extensions={"trace": self.__trace} if self.tracer else None,
+                    ),
+                    stream=stream,
+                )
+            except Exception as exc:
+                self.metrics.record(None, monotonic() - start)
+                if (
+                    not isinstance(exc, self.retry_exceptions)
+                    or attempt == attempts - 1
+                ):
+                    raise
+                continue
+            self.metrics.record(response.status_code, monotonic() - start)
+            if self._is_final(response, attempt, attempts):
+                return response
+            await response.aclose()
+
+    async def __trace(self, name, info) -> None:
+        if name in TRACE_EVENTS:
+            self.tracer.event(TRACE_EVENTS[name])
+
+    async def aclose(self) -> None:
+        """
+        Close pooled connections
+        """
+        await self.client.aclose()